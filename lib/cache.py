@@ -1,6 +1,8 @@
-
+import collections
 import functools
 import logging
+import re
+import time
 
 import redis
 
@@ -12,15 +14,114 @@ redis_opts = {
     'host': 'localhost',
     'port': 6379,
     'db': 0,
-    'password': None
+    'password': None,
+    # Lifetime in seconds of the exists() answers
+    'exists_ttl': 10
 }
 redis_conn = None
 cache_prefix = None
+exists_prefix = None
+exists_index_prefix = None
+
+# In-process LRU, in front of Redis
+local_opts = {
+    'max_entries': 1024,
+    'max_bytes': 32 * 1024 * 1024
+}
+local_cache = None
+# Only the image metadata which never changes once the image push is
+# complete can be kept in memory, other workers cannot invalidate it. It is
+# not kept while the push is in progress (see `local_fill').
+local_paths = re.compile(
+    r'^images/[^/]+/(json|ancestry|_checksum|_layer_link)$')
+
+# Results of the token validations, in-process and in Redis
+token_ttl = 0
+token_cache = None
+token_prefix = None
+
+# Content and digest of the mutable files written recently by this worker
+# (the images lists). Other workers may change them, so they are only kept
+# for a short time in-process, Redis is trusted when available.
+recent_ttl = 60
+recent_cache = None
+digest_cache = None
+digest_prefix = None
+
+
+class LRUCache(object):
+
+    """Least recently used cache bounded both in number of entries and in
+       total size of the values.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._data = collections.OrderedDict()
+        # Expiration time of the entries set with a ttl
+        self._expires = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._data[key] = value
+        return value
+
+    def set(self, key, value, ttl=None):
+        if not isinstance(value, basestring) or len(value) > self._max_bytes:
+            return
+        self.delete(key)
+        self._data[key] = value
+        self._size += len(value)
+        if ttl is not None:
+            self._expires[key] = time.time() + ttl
+        while len(self._data) > self._max_entries or \
+                self._size > self._max_bytes:
+            old_key, old = self._data.popitem(last=False)
+            self._size -= len(old)
+            self._expires.pop(old_key, None)
+
+    def delete(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._size -= len(value)
+        self._expires.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        for key in [k for k in self._data if k.startswith(prefix)]:
+            self.delete(key)
 
 
 def init():
-    global redis_conn, cache_prefix
+    global redis_conn, cache_prefix, exists_prefix, exists_index_prefix
+    global local_cache
+    global token_ttl, token_cache, token_prefix
+    global recent_cache, digest_cache, digest_prefix
     cfg = config.load()
+    token_ttl = int(cfg.get('token_cache_ttl', token_ttl))
+    if token_ttl > 0:
+        token_cache = LRUCache(10000, 10000)
+    recent_cache = LRUCache(1024, 16 * 1024 * 1024)
+    digest_cache = LRUCache(10000, 10000 * 64)
+    local = cfg.cache_local
+    if local:
+        if not isinstance(local, dict):
+            local = {}
+        for k, v in local.iteritems():
+            local_opts[k] = v
+        logging.info('Enabling in-process storage cache: {0}'.format(
+            local_opts))
+        local_cache = LRUCache(int(local_opts['max_entries']),
+                               int(local_opts['max_bytes']))
     cache = cfg.cache_lru
     if not cache:
         return
@@ -35,21 +136,151 @@ def init():
                                    db=int(redis_opts['db']),
                                    password=redis_opts['password'])
     cache_prefix = 'cache_path:{0}'.format(cfg.get('storage_path', '/'))
+    exists_prefix = 'cache_exists:{0}'.format(cfg.get('storage_path', '/'))
+    exists_index_prefix = 'cache_exists_index:{0}'.format(
+        cfg.get('storage_path', '/'))
+    token_prefix = 'cache_token:{0}'.format(cfg.get('storage_path', '/'))
+    digest_prefix = 'cache_digest:{0}'.format(cfg.get('storage_path', '/'))
 
 
 def cache_key(key):
     return cache_prefix + key
 
 
+def exists_key(key):
+    return exists_prefix + key
+
+
+def exists_index_key(directory):
+    """Set of the paths under directory whose exists() answer is cached."""
+    return exists_index_prefix + directory.rstrip('/')
+
+
+def _parent(key):
+    """Returns the directory containing key, None for the paths right under
+       the top-level directories (never removed, their sets would only grow).
+    """
+    parts = key.strip('/').split('/')
+    if len(parts) < 3:
+        return None
+    return '/'.join(parts[:-1])
+
+
+def enabled():
+    return redis_conn is not None or local_cache is not None
+
+
+def local_get(key):
+    if local_cache is None or not local_paths.match(key):
+        return
+    return local_cache.get(key)
+
+
+def local_fill(store, key, content):
+    """Keeps content in memory if the push of its image is complete. The
+       mark is checked after the content is read: a complete image is never
+       pushed again, so the content read cannot change anymore.
+    """
+    if local_cache is None or not local_paths.match(key):
+        return
+    if store.exists(store.image_mark_path(key.split('/')[1])):
+        # A retried push may still rewrite it, on any worker
+        return
+    local_cache.set(key, content)
+
+
+def local_delete(key, recursive=False):
+    if local_cache is None:
+        return
+    local_cache.delete(key)
+    if recursive:
+        local_cache.delete_prefix(key.rstrip('/') + '/')
+
+
+def get_token(key):
+    """Returns the cached result of a token validation, None if unknown."""
+    if token_cache is None:
+        return
+    valid = token_cache.get(key)
+    if valid is None and redis_conn is not None:
+        # Validated by another worker
+        pipe = redis_conn.pipeline()
+        pipe.get(token_prefix + key)
+        pipe.ttl(token_prefix + key)
+        valid, ttl = pipe.execute()
+        if valid is not None and ttl > 0:
+            token_cache.set(key, valid, ttl)
+    if valid is not None:
+        return valid == '1'
+
+
+def set_token(key, valid):
+    if token_cache is None:
+        return
+    valid = '1' if valid else '0'
+    token_cache.set(key, valid, token_ttl)
+    if redis_conn is not None:
+        redis_conn.setex(token_prefix + key, token_ttl, valid)
+
+
+def recent_get(key):
+    return recent_cache.get(key)
+
+
+def recent_set(key, content):
+    recent_cache.set(key, content, recent_ttl)
+
+
+def get_digest(key):
+    """Returns the digest of the content last written to key, if known."""
+    if redis_conn is not None:
+        return redis_conn.get(digest_prefix + key)
+    return digest_cache.get(key)
+
+
+def set_digest(key, digest):
+    digest_cache.set(key, digest, recent_ttl)
+    if redis_conn is not None:
+        # Expires as well, removing a directory does not invalidate it
+        redis_conn.setex(digest_prefix + key, recent_ttl, digest)
+
+
+def delete_digest(key):
+    """Forgets the digest of key, once the file has been removed."""
+    digest_cache.delete(key)
+    if redis_conn is not None:
+        redis_conn.delete(digest_prefix + key)
+
+
 def put(f):
     @functools.wraps(f)
     def wrapper(*args):
         content = args[-1]
         key = args[-2]
-        key = cache_key(key)
-        redis_conn.set(key, content)
-        return f(*args)
-    if redis_conn is None:
+        ret = f(*args)
+        # After the write: a concurrent exists() miss would cache a negative
+        # answer otherwise
+        local_delete(key)
+        if redis_conn is not None:
+            redis_conn.set(cache_key(key), content)
+            redis_conn.delete(exists_key(key))
+        return ret
+    if not enabled():
+        return f
+    return wrapper
+
+
+def put_stream(f):
+    """Same as `put' for stream_write, the content itself is not cached."""
+    @functools.wraps(f)
+    def wrapper(*args):
+        key = args[-2]
+        ret = f(*args)
+        local_delete(key)
+        if redis_conn is not None:
+            redis_conn.delete(cache_key(key), exists_key(key))
+        return ret
+    if not enabled():
         return f
     return wrapper
 
@@ -58,27 +289,86 @@ def get(f):
     @functools.wraps(f)
     def wrapper(*args):
         key = args[-1]
-        key = cache_key(key)
-        content = redis_conn.get(key)
+        content = local_get(key)
         if content is not None:
             return content
-        # Refresh cache
-        content = f(*args)
-        redis_conn.set(key, content)
+        if redis_conn is not None:
+            content = redis_conn.get(cache_key(key))
+        if content is None:
+            # Refresh cache
+            content = f(*args)
+            if redis_conn is not None:
+                redis_conn.set(cache_key(key), content)
+        local_fill(args[0], key, content)
         return content
-    if redis_conn is None:
+    if not enabled():
         return f
     return wrapper
 
 
+def invalidate(key):
+    local_delete(key, recursive=True)
+    if redis_conn is not None:
+        # The path may be a directory, the answers cached for the paths it
+        # contains are dropped as well
+        index = exists_index_key(key)
+        keys = [exists_key(k) for k in redis_conn.smembers(index)]
+        redis_conn.delete(cache_key(key), exists_key(key), index, *keys)
+
+
 def remove(f):
+    @functools.wraps(f)
+    def wrapper(*args):
+        try:
+            return f(*args)
+        finally:
+            invalidate(args[-1])
+    if not enabled():
+        return f
+    return wrapper
+
+
+def move(f):
+    """Same as `remove' for both the source and the destination."""
+    @functools.wraps(f)
+    def wrapper(*args):
+        try:
+            return f(*args)
+        finally:
+            invalidate(args[-2])
+            invalidate(args[-1])
+    if not enabled():
+        return f
+    return wrapper
+
+
+def exists(f):
+    """Caches the answers of exists(), including the negative ones. Each
+       answer is indexed under the directory containing the path, so that
+       removing that directory drops them (see `remove'). They expire after
+       a short time anyway.
+    """
     @functools.wraps(f)
     def wrapper(*args):
         key = args[-1]
-        key = cache_key(key)
-        redis_conn.delete(key)
-        return f(*args)
-    if redis_conn is None:
+        if local_get(key) is not None:
+            return True
+        if redis_conn is None:
+            return f(*args)
+        ret = redis_conn.get(exists_key(key))
+        if ret is not None:
+            return ret == '1'
+        ret = f(*args)
+        ttl = int(redis_opts['exists_ttl'])
+        pipe = redis_conn.pipeline()
+        pipe.setex(exists_key(key), ttl, '1' if ret else '0')
+        directory = _parent(key)
+        if directory is not None:
+            pipe.sadd(exists_index_key(directory), key)
+            pipe.expire(exists_index_key(directory), ttl)
+        pipe.execute()
+        return ret
+    if not enabled():
         return f
     return wrapper
 
@@ -1,7 +1,9 @@
 
+import bz2
 import hashlib
 import logging
 import tarfile
+import zlib
 
 
 TarError = tarfile.TarError
@@ -24,24 +26,35 @@ def sha256_string(s):
     return hashlib.sha256(s).hexdigest()
 
 
-def compute_tarsum(fp, json_data):
+def _tarsum_header(member):
     header_fields = ('name', 'mode', 'uid', 'gid', 'size', 'mtime',
                      'type', 'linkname', 'uname', 'gname', 'devmajor',
                      'devminor')
+    header = ''
+    for field in header_fields:
+        value = getattr(member, field)
+        if field == 'type':
+            field = 'typeflag'
+        elif field == 'name':
+            if member.isdir() and not value.endswith('/'):
+                value += '/'
+        header += '{0}{1}'.format(field, value)
+    return header
+
+
+def _tarsum_result(json_data, hashes):
+    hashes.sort()
+    data = json_data + ''.join(hashes)
+    return 'tarsum+sha256:{0}'.format(sha256_string(data))
+
+
+def compute_tarsum(fp, json_data):
     tar = None
     hashes = []
     try:
         tar = tarfile.open(mode='r|*', fileobj=fp)
         for member in tar:
-            header = ''
-            for field in header_fields:
-                value = getattr(member, field)
-                if field == 'type':
-                    field = 'typeflag'
-                elif field == 'name':
-                    if member.isdir() and not value.endswith('/'):
-                        value += '/'
-                header += '{0}{1}'.format(field, value)
+            header = _tarsum_header(member)
             h = None
             try:
                 if member.size > 0:
@@ -52,7 +65,6 @@ def compute_tarsum(fp, json_data):
             except KeyError:
                 h = sha256_string(header)
             hashes.append(h)
-        hashes.sort()
     except tarfile.ReadError as e:
         if e.message != 'empty file':
             # NOTE(samalba): ignore empty tarfiles but still let the tarsum
@@ -61,12 +73,179 @@ def compute_tarsum(fp, json_data):
     finally:
         if tar:
             tar.close()
-    data = json_data + ''.join(hashes)
-    tarsum = 'tarsum+sha256:{0}'.format(sha256_string(data))
+    tarsum = _tarsum_result(json_data, hashes)
     logger.debug('checksums.compute_tarsum: return {0}'.format(tarsum))
     return tarsum
 
 
+class _NeedMoreData(Exception):
+    pass
+
+
+class TarSum(object):
+
+    """Computes the same tarsum as `compute_tarsum' on a layer which is fed
+       chunk by chunk through `update', without ever seeking back into it.
+       Headers are parsed by the tarfile module out of the current chunk,
+       member data is hashed as it goes by and never buffered.
+       The paths of the regular files are collected in `files' as well.
+    """
+
+    # Attributes read by tarfile.TarInfo when parsing a header
+    encoding = tarfile.ENCODING
+    errors = 'strict'
+
+    def __init__(self, json_data):
+        self._json_data = json_data
+        self._hashes = []
+        self.files = []
+        self._error = None
+        self._done = False
+        self._eof = False
+        self._magic = ''
+        self._detected = False
+        self._decompressor = None
+        # `_buf' holds the stream starting at the absolute offset
+        # `_buf_offset', everything before `_pos' has been processed.
+        self._buf = ''
+        self._buf_offset = 0
+        self._pos = 0
+        self._cursor = 0
+        # Member being hashed, data bytes left to hash then padding to skip
+        self._hash = None
+        self._data_left = 0
+        self._skip_left = 0
+        # TarFile interface used by tarfile.TarInfo.fromtarfile
+        self.fileobj = self
+        self.offset = 0
+        self.pax_headers = {}
+
+    def read(self, size):
+        start = self._cursor - self._buf_offset
+        buf = self._buf[start:start + size]
+        if len(buf) < size and not self._eof:
+            raise _NeedMoreData()
+        self._cursor += len(buf)
+        return buf
+
+    def tell(self):
+        return self._cursor
+
+    def update(self, buf):
+        if self._done or self._error:
+            return
+        try:
+            if not self._detected:
+                self._magic += buf
+                if len(self._magic) < 10 and not self._eof:
+                    return
+                buf, self._magic = self._magic, ''
+                self._detect_compression(buf)
+            if self._decompressor:
+                buf = self._decompressor.decompress(buf) if buf else ''
+                if self._eof and hasattr(self._decompressor, 'flush'):
+                    buf += self._decompressor.flush()
+            self._feed(buf)
+        except (IOError, EOFError, zlib.error) as e:
+            self._error = tarfile.ReadError(str(e))
+        except tarfile.TarError as e:
+            self._error = e
+
+    def _detect_compression(self, buf):
+        # Same detection as tarfile.open(mode='r|*')
+        if buf.startswith('\037\213\010'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif buf[0:3] == 'BZh' and buf[4:10] == '1AY&SY':
+            self._decompressor = bz2.BZ2Decompressor()
+        self._detected = True
+
+    def _feed(self, buf):
+        self._buf = self._buf[self._pos - self._buf_offset:] + buf
+        self._buf_offset = self._pos
+        end = self._buf_offset + len(self._buf)
+        while not self._done:
+            avail = end - self._pos
+            if self._data_left or self._skip_left:
+                if not avail:
+                    break
+                self._consume(avail)
+            elif not self._next_member():
+                break
+
+    def _consume(self, avail):
+        start = self._pos - self._buf_offset
+        if self._data_left:
+            size = min(avail, self._data_left)
+            self._hash.update(buffer(self._buf, start, size))
+            self._data_left -= size
+            if not self._data_left:
+                self._hashes.append(self._hash.hexdigest())
+                self._hash = None
+        else:
+            size = min(avail, self._skip_left)
+            self._skip_left -= size
+        self._pos += size
+
+    def _next_member(self):
+        """Parses the header starting at `_pos'. Returns False when it could
+           not be parsed yet, or when the end of the archive is reached.
+        """
+        self._cursor = self._pos
+        try:
+            member = tarfile.TarInfo.fromtarfile(self)
+        except _NeedMoreData:
+            return False
+        except tarfile.EOFHeaderError:
+            self._done = True
+            return False
+        except tarfile.SubsequentHeaderError as e:
+            raise tarfile.ReadError(str(e))
+        except tarfile.HeaderError as e:
+            # Same as TarFile.next(): a bad header ends the archive unless
+            # it is the first one. An empty stream is not an error.
+            if self._pos == 0 and str(e) != 'empty header':
+                raise tarfile.ReadError(str(e))
+            self._done = True
+            return False
+        if member.type == tarfile.GNUTYPE_SPARSE:
+            raise tarfile.ReadError('sparse members are not supported')
+        if member.isfile():
+            path = member.path
+            self.files.append(path[1:] if path.startswith('.') else path)
+        header = _tarsum_header(member)
+        data_size = 0
+        if member.isreg() or member.type not in tarfile.SUPPORTED_TYPES:
+            data_size = member.size
+        if data_size > 0:
+            self._hash = hashlib.sha256(header)
+            self._data_left = data_size
+        else:
+            self._hashes.append(sha256_string(header))
+        self._pos = member.offset_data
+        self._skip_left = self.offset - member.offset_data - data_size
+        return True
+
+    def compute(self):
+        """Returns the tarsum once the whole layer went through `update'.
+           Raises a TarError if the layer is not a valid tar archive.
+        """
+        self._eof = True
+        self.update('')
+        if self._data_left or self._skip_left:
+            if not self._done and not self._error:
+                self._error = tarfile.ReadError('unexpected end of data')
+        if self._error:
+            raise self._error
+        tarsum = _tarsum_result(self._json_data, list(self._hashes))
+        logger.debug('checksums.TarSum: return {0}'.format(tarsum))
+        return tarsum
+
+
+def tarsum_handler(json_data):
+    tarsum = TarSum(json_data)
+    return tarsum, tarsum.update
+
+
 def simple_checksum_handler(json_data):
     h = hashlib.sha256(json_data + '\n')
 
@@ -75,6 +254,15 @@ def simple_checksum_handler(json_data):
     return h, fn
 
 
+def content_checksum_handler():
+    """Checksum of the layer alone, it identifies identical layers."""
+    h = hashlib.sha256()
+
+    def fn(buf):
+        h.update(buf)
+    return h, fn
+
+
 def compute_simple(fp, json_data):
     data = json_data + '\n'
     return 'sha256:{0}'.format(sha256_file(fp, data))
@@ -65,5 +65,9 @@ def load():
     if 'privileged_key' in config:
         with open(config['privileged_key']) as f:
             config['privileged_key'] = rsa.PublicKey.load_pkcs1(f.read())
+    if config.get('layer_dedup') is True and \
+            str(config.get('storage')).lower() == 'glance':
+        # Glance cannot move the layers to their blob
+        raise ValueError('layer_dedup is not supported by the glance storage')
     _config = Config(config)
     return _config
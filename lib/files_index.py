@@ -0,0 +1,156 @@
+"""Compact index of the files of a layer.
+
+The paths are sorted and stored in blocks of `block_size' paths. Within a
+block, each path only stores the suffix it does not share with the previous
+one, the first path of a block is stored whole. The offsets of the blocks
+follow them, so a lookup binary searches the first paths of the blocks and
+only decodes the block it lands on:
+
+    MAGIC | blocks | offset of each block | number of paths | number of blocks
+
+Each path is encoded as: shared prefix length, suffix length, suffix (the
+lengths are varints, the trailing numbers are big endian uint32).
+"""
+
+import struct
+
+
+MAGIC = 'FIDX1\n'
+block_size = 64
+
+_footer = struct.Struct('>II')
+
+
+def _encode_varint(value):
+    data = ''
+    while value > 0x7f:
+        data += chr((value & 0x7f) | 0x80)
+        value >>= 7
+    return data + chr(value)
+
+
+def _decode_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _shared_length(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def build(paths):
+    """Returns the index of the given paths, duplicates are dropped."""
+    paths = sorted(set(paths))
+    chunks = [MAGIC]
+    offsets = []
+    pos = len(MAGIC)
+    previous = ''
+    for i, path in enumerate(paths):
+        if i % block_size == 0:
+            offsets.append(pos)
+            previous = ''
+        shared = _shared_length(previous, path)
+        entry = (_encode_varint(shared) +
+                 _encode_varint(len(path) - shared) + path[shared:])
+        chunks.append(entry)
+        pos += len(entry)
+        previous = path
+    chunks.append(struct.pack('>{0}I'.format(len(offsets)), *offsets))
+    chunks.append(_footer.pack(len(paths), len(offsets)))
+    return ''.join(chunks)
+
+
+def is_index(data):
+    return data.startswith(MAGIC)
+
+
+class FilesIndex(object):
+
+    """Reads an index built by `build'. Raises ValueError if it is not
+       valid.
+    """
+
+    def __init__(self, data):
+        if not is_index(data) or len(data) < len(MAGIC) + _footer.size:
+            raise ValueError('Invalid files index')
+        self._data = data
+        self._count, num_blocks = _footer.unpack_from(
+            data, len(data) - _footer.size)
+        self._end = len(data) - _footer.size - 4 * num_blocks
+        if self._end < len(MAGIC):
+            raise ValueError('Invalid files index')
+        self._offsets = struct.unpack_from('>{0}I'.format(num_blocks), data,
+                                           self._end)
+
+    def __len__(self):
+        return self._count
+
+    def _first_path(self, block):
+        # The first path of a block does not share anything
+        pos = self._offsets[block] + 1
+        length, pos = _decode_varint(self._data, pos)
+        return self._data[pos:pos + length]
+
+    def _iter_block(self, block):
+        data = self._data
+        pos = self._offsets[block]
+        if block + 1 < len(self._offsets):
+            end = self._offsets[block + 1]
+        else:
+            end = self._end
+        path = ''
+        while pos < end:
+            shared, pos = _decode_varint(data, pos)
+            length, pos = _decode_varint(data, pos)
+            path = path[:shared] + data[pos:pos + length]
+            pos += length
+            yield path
+
+    def _find_block(self, path):
+        """Returns the block which would hold path."""
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._first_path(mid) <= path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(lo - 1, 0)
+
+    def __iter__(self):
+        return self.iter_from('')
+
+    def iter_from(self, start):
+        """Yields the paths greater than or equal to start, in order."""
+        if not self._offsets:
+            return
+        for block in xrange(self._find_block(start), len(self._offsets)):
+            for path in self._iter_block(block):
+                if path >= start:
+                    yield path
+
+    def list(self, prefix='', marker=None, limit=None):
+        """Returns the paths starting with prefix which come after marker,
+           up to limit of them.
+        """
+        paths = []
+        start = max(prefix, marker) if marker else prefix
+        for path in self.iter_from(start):
+            if not path.startswith(prefix):
+                break
+            if path == marker:
+                continue
+            if limit is not None and len(paths) >= limit:
+                break
+            paths.append(path)
+        return paths
@@ -2,6 +2,9 @@
 import contextlib
 import tempfile
 
+import gevent.pool
+import simplejson as json
+
 import config
 
 
@@ -14,14 +17,22 @@ class Storage(object):
     $ROOT/images/<image_id>/json
     $ROOT/images/<image_id>/layer
     $ROOT/repositories/<namespace>/<repository_name>/<tag_name>
+    $ROOT/blobs/<algorithm>/<digest>/layer (deduplicated layers)
     """
 
     # Useful if we want to change those locations later without rewriting
     # the code which uses Storage
     repositories = 'repositories'
     images = 'images'
+    blobs = 'blobs'
     # Set the IO buffer to 128kB
     buffer_size = 128 * 1024
+    # True if stream_read accepts a bytes_range
+    supports_bytes_range = False
+    # Number of concurrent requests issued by the multi_* methods
+    concurrency = 1
+    # Maximum number of ids stored in the ancestry file of an image
+    ancestry_piece_size = 32
 
     #FIXME(samalba): Move all path resolver in each module (out of the base)
     def images_list_path(self, namespace, repository):
@@ -47,6 +58,24 @@ class Storage(object):
     def image_files_path(self, image_id):
         return '{0}/{1}/_files'.format(self.images, image_id)
 
+    def image_layer_link_path(self, image_id):
+        return '{0}/{1}/_layer_link'.format(self.images, image_id)
+
+    def blob_path(self, digest):
+        return '{0}/{1}/layer'.format(self.blobs, digest.replace(':', '/'))
+
+    def blob_ref_path(self, digest, image_id):
+        return '{0}/{1}/refs/{2}'.format(self.blobs, digest.replace(':', '/'),
+                                         image_id)
+
+    def image_metadata_path(self, image_id):
+        return '{0}/{1}/_metadata'.format(self.images, image_id)
+
+    def tags_manifest_path(self, namespace, repository):
+        return '{0}/{1}/{2}/_tags'.format(self.repositories,
+                                          namespace,
+                                          repository)
+
     def tag_path(self, namespace, repository, tagname=None):
         if not tagname:
             return '{0}/{1}/{2}'.format(self.repositories,
@@ -70,21 +99,235 @@ class Storage(object):
     def is_private(self, namespace, repository):
         return self.exists(self.private_flag_path(namespace, repository))
 
+    def get_image_metadata(self, image_id):
+        """Returns the meta-data record of an image, which holds its json,
+           checksum, layer size and the first piece of its ancestry. Raises
+           IOError if the image has no record.
+        """
+        return json.loads(self.get_content(self.image_metadata_path(image_id)))
+
+    def put_image_metadata(self, image_id, **metadata):
+        """Writes the meta-data record of an image, once it is complete."""
+        self.put_content(self.image_metadata_path(image_id),
+                         json.dumps(metadata, separators=(',', ':')))
+
+    def get_image_ancestry(self, image_id, piece=None):
+        """Returns the ids of the image and of all its parents, the closest
+           first. `piece' is the first piece of the ancestry, when it is
+           already known. Raises IOError if a piece of the ancestry is
+           missing.
+        """
+        ancestry = []
+        while image_id or piece:
+            if piece is None:
+                piece = json.loads(
+                    self.get_content(self.image_ancestry_path(image_id)))
+            if isinstance(piece, list):
+                # Whole ancestry, as stored before
+                return ancestry + piece
+            ancestry.extend(piece['ids'])
+            image_id = piece['next']
+            piece = None
+        return ancestry
+
+    def put_image_ancestry(self, image_id, parent_id=None, pieces=True):
+        """Each image only stores the ids of its closest parents, up to
+           `ancestry_piece_size' ids, followed by the id of the image holding
+           the next piece. Pieces are shared by the images built on top of the
+           same parents and never grow with the depth of the image. Without
+           `pieces', the whole ancestry is stored as a list, as before.
+        """
+        if not pieces:
+            ancestry = [image_id]
+            if parent_id:
+                ancestry.extend(self.get_image_ancestry(parent_id))
+            self.put_content(self.image_ancestry_path(image_id),
+                             json.dumps(ancestry))
+            return ancestry
+        piece = {'ids': [image_id], 'next': None}
+        if parent_id:
+            parent = json.loads(
+                self.get_content(self.image_ancestry_path(parent_id)))
+            if isinstance(parent, list):
+                parent = {'ids': parent, 'next': None}
+            if len(parent['ids']) < self.ancestry_piece_size:
+                piece['ids'].extend(parent['ids'])
+                piece['next'] = parent['next']
+            else:
+                piece['next'] = parent_id
+        self.put_content(self.image_ancestry_path(image_id),
+                         json.dumps(piece, separators=(',', ':')))
+        return piece
+
+    def get_image_layer_path(self, image_id):
+        """Returns the path the layer is actually stored at: the blob it
+           links to if it has been deduplicated, its own path otherwise.
+        """
+        try:
+            digest = self.get_content(self.image_layer_link_path(image_id))
+        except IOError:
+            return self.image_layer_path(image_id)
+        return self.blob_path(digest)
+
+    def link_image_layer(self, image_id, digest):
+        """Points the layer of the image to the blob of that digest. Each
+           image referencing a blob has its own file under it, there is no
+           count to update concurrently.
+        """
+        self.put_content(self.blob_ref_path(digest, image_id), image_id)
+        self.put_content(self.image_layer_link_path(image_id), digest)
+
+    def unlink_image_layer(self, image_id):
+        """Drops the link of the image to its blob. The blob itself is
+           never removed here: another push may be linking to it.
+        """
+        link_path = self.image_layer_link_path(image_id)
+        try:
+            digest = self.get_content(link_path)
+        except IOError:
+            return
+        self.remove(link_path)
+        self.remove(self.blob_ref_path(digest, image_id))
+
+    def map(self, fn, items):
+        """Calls fn on each item, concurrently if the backend allows it."""
+        if self.concurrency <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        pool = gevent.pool.Pool(self.concurrency)
+        jobs = [pool.spawn(fn, item) for item in items]
+        pool.join()
+        return [job.get() for job in jobs]
+
+    def multi_get(self, paths):
+        """Returns a dict of the content of each path, the missing ones
+           are left out.
+        """
+        def fetch(path):
+            try:
+                return path, self.get_content(path)
+            except IOError:
+                return path, None
+        results = self.map(fetch, list(paths))
+        return dict((path, content) for path, content in results
+                    if content is not None)
+
+    def multi_exists(self, paths):
+        """Returns a dict telling whether each path exists."""
+        paths = list(paths)
+        return dict(zip(paths, self.map(self.exists, paths)))
+
+    def multi_size(self, paths):
+        """Returns a dict of the size of each path, the missing ones are
+           left out.
+        """
+        def size(path):
+            try:
+                return path, self.get_size(path)
+            except (IOError, OSError):
+                return path, None
+        results = self.map(size, list(paths))
+        return dict((path, size) for path, size in results
+                    if size is not None)
+
     def get_content(self, path):
         raise NotImplementedError
 
     def put_content(self, path, content):
         raise NotImplementedError
 
-    def stream_read(self, path):
+    def stream_read(self, path, bytes_range=None):
+        """bytes_range is an optional (start, end) tuple, both inclusive."""
         raise NotImplementedError
 
     def stream_write(self, path, fp):
         raise NotImplementedError
 
+    def move(self, src, dst):
+        """Moves src to dst, backends which can do better than copying the
+           content through the registry override it.
+        """
+        self.stream_write(dst, _StreamReader(self.stream_read(src)))
+        self.remove(src)
+
     def list_directory(self, path=None):
         raise NotImplementedError
 
+    def list_page(self, path, marker=None, limit=None, prefix=''):
+        """Returns the names under path whose last part starts with prefix,
+           in order, up to limit of them, along with the marker to pass to
+           get the next page (None on the last page), the name to resume
+           after. Unlike list_directory, a missing directory is an empty page.
+           Backends which can list a page at a time override it.
+        """
+        try:
+            names = sorted(self.list_directory(path))
+        except OSError:
+            return [], None
+        if marker is not None:
+            # Compared by last part, which some backends only list
+            marker = marker.split('/').pop()
+        names = [name for name in names
+                 if name.split('/').pop().startswith(prefix) and
+                 (marker is None or name.split('/').pop() > marker)]
+        if limit is not None and len(names) > limit:
+            return names[:limit], names[limit - 1]
+        return names, None
+
+    def _list_gap(self, path, after=None, before=None):
+        """Returns the names under path whose last part sorts after the ones
+           starting with after and before the ones starting with before.
+        """
+        marker = None
+        if after is not None:
+            # Sorts after any name starting with after (U+FFFF in UTF-8)
+            marker = '{0}/{1}\xef\xbf\xbf'.format(path.rstrip('/'), after)
+        names = []
+        while True:
+            page, marker = self.list_page(path, marker=marker, limit=100)
+            for name in page:
+                if before is not None and \
+                        name.split('/').pop() >= before:
+                    return names
+                names.append(name)
+            if marker is None:
+                return names
+
+    def list_directory_parallel(self, path, prefixes='0123456789abcdef'):
+        """Returns the names under path, the ones whose last part starts with
+           one of prefixes (the first characters of the image ids by default)
+           being listed concurrently if the backend allows it. The others are
+           listed afterwards. Raises OSError if there is none.
+        """
+        if self.concurrency <= 1:
+            # Listing each prefix would list the whole directory each time
+            names = sorted(self.list_directory(path))
+        else:
+            def list_prefix(prefix):
+                names = []
+                marker = None
+                while True:
+                    page, marker = self.list_page(path, marker=marker,
+                                                  prefix=prefix)
+                    names.extend(page)
+                    if marker is None:
+                        return names
+            prefixes = sorted(prefixes)
+            names = []
+            for page in self.map(list_prefix, prefixes):
+                names.extend(page)
+            # The names starting with none of the prefixes, found in the gaps
+            # between them. Each gap is usually empty, a single request.
+            gaps = [(None, prefixes[0])]
+            gaps.extend((a, b) for a, b in zip(prefixes, prefixes[1:])
+                        if ord(b) != ord(a) + 1)
+            gaps.append((prefixes[-1], None))
+            for after, before in gaps:
+                names.extend(self._list_gap(path, after, before))
+            names.sort()
+        if not names:
+            raise OSError('No such directory: \'{0}\''.format(path))
+        return names
+
     def exists(self, path):
         raise NotImplementedError
 
@@ -94,6 +337,32 @@ class Storage(object):
     def get_size(self, path):
         raise NotImplementedError
 
+    def content_redirect_url(self, path):
+        """Returns a temporary URL the client can fetch the content from
+           directly, or None if the backend cannot serve it that way.
+        """
+        return None
+
+
+class _StreamReader(object):
+
+    """File-like object reading the output of stream_read."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size < 0:
+            size = len(self._buf)
+        buf, self._buf = self._buf[:size], self._buf[size:]
+        return buf
+
 
 @contextlib.contextmanager
 def store_stream(stream):
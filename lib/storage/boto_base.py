@@ -6,7 +6,10 @@ import copy
 import logging
 import math
 import os
-import tempfile
+
+import boto.exception
+import gevent
+import gevent.queue
 
 import cache
 
@@ -17,85 +20,106 @@ logger = logging.getLogger(__name__)
 
 class ParallelKey(object):
 
-    """This class implements parallel transfer on a key to improve speed."""
+    """This class implements parallel transfer on a key to improve speed.
+
+       The key is fetched in parts with concurrent range requests and served
+       in order as soon as the data arrives. At most `concurrency' parts are
+       buffered in memory ahead of the reader, a part is only requested once
+       the reader made room for it.
+    """
 
-    CONCURRENCY = 5
+    min_part_size = 1024 * 1024
+    max_part_size = 4 * 1024 * 1024
+    max_concurrency = 8
+    # Size of the reads on each range request
+    chunk_size = 128 * 1024
 
     def __init__(self, key):
-        logger.info('ParallelKey: {0}; size={1}'.format(key, key.size))
+        size = key.size
+        # Aim for twice as many parts as workers, within the part size bounds
+        part_size = size // (2 * self.max_concurrency)
+        self._part_size = max(self.min_part_size,
+                              min(self.max_part_size, part_size))
+        num_parts = int(math.ceil(1.0 * size / self._part_size))
+        self._concurrency = max(1, min(self.max_concurrency, num_parts))
+        logger.info('ParallelKey: {0}; size={1}; part_size={2}; '
+                    'concurrency={3}'.format(key, size, self._part_size,
+                                             self._concurrency))
         self._boto_key = key
         self._cursor = 0
-        self._max_completed_byte = 0
-        self._max_completed_index = 0
-        self._tmpfile = tempfile.NamedTemporaryFile(mode='rb')
-        self._completed = [0] * self.CONCURRENCY
-        self._spawn_jobs()
-
-    def __del__(self):
-        self._tmpfile.close()
+        self._buf = ''
+        # Queues of the chunks of each part, in order
+        self._parts = gevent.queue.Queue(maxsize=self._concurrency)
+        self._part = None
+        self._greenlets = []
+        self._scheduler = gevent.spawn(self._schedule)
 
-    def _generate_bytes_ranges(self, num_parts):
+    def _generate_bytes_ranges(self):
         size = self._boto_key.size
-        chunk_size = int(math.ceil(1.0 * size / num_parts))
-        for i in range(num_parts):
-            yield (i, chunk_size * i, min(chunk_size * (i + 1) - 1, size - 1))
+        for min_cur in xrange(0, size, self._part_size):
+            yield (min_cur, min(min_cur + self._part_size, size) - 1)
 
-    def _fetch_part(self, fname, index, min_cur, max_cur):
+    def _schedule(self):
+        for min_cur, max_cur in self._generate_bytes_ranges():
+            part = gevent.queue.Queue()
+            # Blocks while `concurrency' parts are ahead of the reader
+            self._parts.put(part)
+            self._greenlets.append(
+                gevent.spawn(self._fetch_part, part, min_cur, max_cur))
+
+    def _fetch_part(self, part, min_cur, max_cur):
         boto_key = copy.copy(self._boto_key)
-        with open(fname, 'wb') as f:
-            f.seek(min_cur)
+        try:
             brange = 'bytes={0}-{1}'.format(min_cur, max_cur)
-            boto_key.get_contents_to_file(f, headers={'Range': brange})
+            boto_key.open_read(headers={'Range': brange})
+            left = max_cur - min_cur + 1
+            while left > 0:
+                buf = boto_key.read(min(self.chunk_size, left))
+                if not buf:
+                    raise IOError('Transfer interrupted at {0} bytes from '
+                                  'the end of the range {1}'.format(left,
+                                                                    brange))
+                left -= len(buf)
+                part.put(buf)
+            part.put(None)
+        except Exception as e:
+            logger.error('ParallelKey: {0}; {1}'.format(self._boto_key, e))
+            part.put(e)
+        finally:
             boto_key.close()
-        self._completed[index] = (index, max_cur)
-        self._refresh_max_completed_byte()
-
-    def _spawn_jobs(self):
-        bytes_ranges = self._generate_bytes_ranges(self.CONCURRENCY)
-        for i, min_cur, max_cur in bytes_ranges:
-            gevent.spawn(self._fetch_part, self._tmpfile.name,
-                         i, min_cur, max_cur)
-
-    def _refresh_max_completed_byte(self):
-        for v in self._completed[self._max_completed_index:]:
-            if v == 0:
-                return
-            self._max_completed_index = v[0]
-            self._max_completed_byte = v[1]
-            if self._max_completed_index >= len(self._completed) - 1:
-                percent = round(
-                    (100.0 * self._cursor) / self._boto_key.size, 1)
-                logger.info('ParallelKey: {0}; buffering complete at {1}% of '
-                            'the total transfer; now serving straight from '
-                            'the tempfile'.format(self._boto_key, percent))
 
     def read(self, size):
-        if self._cursor >= self._boto_key.size:
-            # Read completed
-            return ''
-        sz = size
-        if self._max_completed_index < len(self._completed) - 1:
-            # Not all data arrived yet
-            if self._cursor + size > self._max_completed_byte:
-                while self._cursor >= self._max_completed_byte:
-                    # We're waiting for more data to arrive
-                    gevent.sleep(0.2)
-            if self._cursor + sz > self._max_completed_byte:
-                sz = self._max_completed_byte - self._cursor
-        # Use a low-level read to avoid any buffering (makes sure we don't
-        # read more than `sz' bytes).
-        buf = os.read(self._tmpfile.file.fileno(), sz)
+        while not self._buf:
+            if self._cursor >= self._boto_key.size:
+                # Read completed
+                return ''
+            if self._part is None:
+                self._part = self._parts.get()
+            # Waits for the data of the part being read
+            buf = self._part.get()
+            if buf is None:
+                self._part = None
+            elif isinstance(buf, Exception):
+                self.close()
+                raise IOError('ParallelKey: {0}; {1}'.format(self._boto_key,
+                                                             buf))
+            else:
+                self._buf = buf
+        buf = self._buf[:size]
+        self._buf = self._buf[size:]
         self._cursor += len(buf)
-        if not buf:
-            message = ('ParallelKey: {0}; got en empty read on the buffer! '
-                       'cursor={1}, size={2}; Transfer interrupted.'.format(
-                           self._boto_key, self._cursor, self._boto_key.size))
-            logging.error(message)
-            raise RuntimeError(message)
         return buf
 
+    def close(self):
+        """Stops the transfer, if the reader gives up before the end."""
+        gevent.killall([self._scheduler] + self._greenlets)
+
 
 class BotoStorage(Storage):
+
+    supports_bytes_range = True
+    concurrency = 16
+
     def __init__(self, config):
         self._config = config
         self._root_path = self._config.storage_path
@@ -121,40 +145,71 @@ class BotoStorage(Storage):
             return path[1:]
         return path
 
-    def stream_read(self, path):
+    def stream_read(self, path, bytes_range=None):
         path = self._init_path(path)
         key = self._boto_bucket.lookup(path)
         if not key:
             raise IOError('No such key: \'{0}\''.format(path))
-        if key.size > 1024 * 1024:
+        if bytes_range:
+            # Only the requested range goes through, in a single GET
+            brange = 'bytes={0}-{1}'.format(*bytes_range)
+            key.open_read(headers={'Range': brange})
+        elif key.size > 1024 * 1024:
             # Use the parallel key only if the key size is > 1MB
             key = ParallelKey(key)
-        while True:
-            buf = key.read(self.buffer_size)
-            if not buf:
-                break
-            yield buf
+        try:
+            while True:
+                buf = key.read(self.buffer_size)
+                if not buf:
+                    break
+                yield buf
+        finally:
+            key.close()
+
+    def _list_name(self, name):
+        """Returns the name of a listed key or prefix, out of the root."""
+        if self._root_path != '/':
+            name = name[len(self._root_path):]
+        if name.endswith('/'):
+            return name[:-1]
+        return name
 
     def list_directory(self, path=None):
         path = self._init_path(path)
         if not path.endswith('/'):
             path += '/'
-        ln = 0
-        if self._root_path != '/':
-            ln = len(self._root_path)
         exists = False
         for key in self._boto_bucket.list(prefix=path, delimiter='/'):
             exists = True
-            name = key.name
-            if name.endswith('/'):
-                yield name[ln:-1]
-            else:
-                yield name[ln:]
+            yield self._list_name(key.name)
         if exists is False:
             # In order to be compliant with the LocalStorage API. Even though
             # GS does not have a concept of folders.
             raise OSError('No such directory: \'{0}\''.format(path))
 
+    def list_page(self, path, marker=None, limit=None, prefix=''):
+        """Lists a single page of up to limit names (1000 at most, the
+           maximum of a request).
+        """
+        path = self._init_path(path)
+        if not path.endswith('/'):
+            path += '/'
+        params = {'prefix': path + prefix, 'delimiter': '/',
+                  'max_keys': min(limit or 1000, 1000)}
+        if marker:
+            params['marker'] = self._init_path(marker)
+        keys = self._boto_bucket.get_all_keys(**params)
+        names = [self._list_name(key.name) for key in keys]
+        marker = None
+        if keys.is_truncated and len(keys):
+            key_name = keys.next_marker or keys[-1].name
+            # Out of the root, keeping the slash of a prefix which would be
+            # listed again otherwise
+            marker = self._list_name(key_name)
+            if key_name.endswith('/'):
+                marker += '/'
+        return names, marker
+
     def get_size(self, path):
         path = self._init_path(path)
         # Lookup does a HEAD HTTP Request on the object
@@ -163,6 +218,14 @@ class BotoStorage(Storage):
             raise OSError('No such key: \'{0}\''.format(path))
         return key.size
 
+    def content_redirect_url(self, path):
+        # Signing is local, the key is not looked up: a missing layer is a
+        # 404 from the storage once the client follows the redirect.
+        key = self.makeKey(self._init_path(path))
+        expires_in = int(self._config.get('storage_redirect_expires', 600))
+        return key.generate_url(expires_in=expires_in, method='GET',
+                                query_auth=True)
+
     @cache.get
     def get_content(self, path):
         path = self._init_path(path)
@@ -171,6 +234,21 @@ class BotoStorage(Storage):
             raise IOError('No such key: \'{0}\''.format(path))
         return key.get_contents_as_string()
 
+    @cache.move
+    def move(self, src, dst):
+        try:
+            # Server side copy
+            self._boto_bucket.copy_key(
+                self._init_path(dst), self._boto_bucket.name,
+                self._init_path(src),
+                encrypt_key=(self._config.s3_encrypt is True))
+        except boto.exception.BotoServerError as e:
+            # S3 cannot copy objects bigger than 5GB in a single request
+            logger.debug('move: Server side copy failed: {0}'.format(e))
+            return super(BotoStorage, self).move(src, dst)
+        self.remove(src)
+
+    @cache.exists
     def exists(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
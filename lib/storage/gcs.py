@@ -3,9 +3,11 @@ import gevent.monkey
 gevent.monkey.patch_all()
 
 import logging
+import uuid
 
 import boto.gs.connection
 import boto.gs.key
+import gevent
 
 import cache
 
@@ -17,8 +19,14 @@ logger = logging.getLogger(__name__)
 
 class GSStorage(BotoStorage):
 
+    # Maximum number of objects composed in one request
+    max_compose = 32
+    # Number of attempts to upload each part of a layer
+    part_retries = 3
+
     def __init__(self, config):
         BotoStorage.__init__(self, config)
+        self._part_size = int(config.get('gs_part_size', 16 * 1024 * 1024))
 
     def makeConnection(self):
         return boto.gs.connection.GSConnection(
@@ -36,11 +44,63 @@ class GSStorage(BotoStorage):
         key.set_contents_from_string(content)
         return path
 
+    def _upload_part(self, key, buf):
+        for attempt in range(self.part_retries):
+            try:
+                key.set_contents_from_string(buf)
+                return
+            except Exception as e:
+                logger.warn('GSStorage: upload of {0} failed (attempt {1}): '
+                            '{2}'.format(key.name, attempt + 1, e))
+                if attempt + 1 < self.part_retries:
+                    gevent.sleep(0.5 * 2 ** attempt)
+        raise IOError('Could not upload \'{0}\': {1}'.format(key.name, e))
+
+    @cache.put_stream
     def stream_write(self, path, fp):
-        # Minimum size of upload part size on GS is 5MB
-        buffer_size = 5 * 1024 * 1024
-        if self.buffer_size > buffer_size:
-            buffer_size = self.buffer_size
+        """The parts are uploaded to temporary objects, composed into a
+           temporary object every `max_compose' objects. The object itself
+           is only written by the last compose request: a failed upload
+           leaves the previous one in place. Only one part is held in memory.
+        """
+        buffer_size = max(self._part_size, self.buffer_size)
         path = self._init_path(path)
-        key = self.makeKey(path)
-        key.set_contents_from_string(fp.read())
+        # Unique to this upload, another one may be writing the same path
+        tmp_path = '{0}._{1}'.format(path, uuid.uuid4().hex)
+        num_part = 0
+        parts = []
+        try:
+            while True:
+                try:
+                    buf = fp.read(buffer_size)
+                    if not buf:
+                        break
+                except IOError:
+                    break
+                if len(parts) == self.max_compose:
+                    composed = self.makeKey('{0}_composed{1}'.format(
+                        tmp_path, num_part))
+                    composed.compose(parts)
+                    self._remove_parts(parts)
+                    parts.append(composed)
+                part = self.makeKey('{0}_part{1}'.format(tmp_path, num_part))
+                self._upload_part(part, buf)
+                parts.append(part)
+                num_part += 1
+                buf = None
+            key = self.makeKey(path)
+            if parts:
+                key.compose(parts)
+            else:
+                key.set_contents_from_string('')
+        finally:
+            self._remove_parts(parts)
+
+    def _remove_parts(self, parts):
+        for part in parts:
+            try:
+                part.delete()
+            except Exception:
+                logger.warn('GSStorage: could not remove {0}'.format(
+                    part.name))
+        del parts[:]
@@ -1,4 +1,5 @@
 
+import functools
 import os
 
 import flask
@@ -19,6 +20,15 @@ class GlanceStorage(object):
        accessing images to the GlanceStorageLayers class below.
     """
 
+    # Glance does not serve partial image data
+    supports_bytes_range = False
+    # Used by the methods of the base class
+    repositories = Storage.repositories
+    images = Storage.images
+    blobs = Storage.blobs
+    concurrency = Storage.concurrency
+    ancestry_piece_size = Storage.ancestry_piece_size
+
     def __init__(self, config):
         self._config = config
         self._storage_layers = GlanceStorageLayers(config)
@@ -37,6 +47,9 @@ class GlanceStorage(object):
             path = kwargs['path']
         elif len(args) > 0 and isinstance(args[0], basestring):
             path = args[0]
+        elif len(args) > 0 and isinstance(args[0], list) and args[0]:
+            # multi_* methods, all the paths are in the same place
+            path = args[0][0]
         if path.startswith(Storage.images):
             obj = self._storage_layers
         elif path.startswith(Storage.repositories):
@@ -45,6 +58,11 @@ class GlanceStorage(object):
             obj = self._storage_base
         if not hasattr(obj, method_name):
             return
+        attr = getattr(Storage, method_name, None)
+        if obj is self._storage_base and callable(attr):
+            # Methods of the base class built on top of the other ones,
+            # their storage calls have to be dispatched as well
+            return functools.partial(attr.im_func, self)
         return getattr(obj, method_name)
 
     def __getattr__(self, name):
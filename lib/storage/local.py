@@ -1,52 +1,147 @@
 
+import contextlib
+import errno
 import os
 import shutil
+import tempfile
 
 import cache
 
 from . import Storage
 
 
+# Files are created with the permissions open() would give them
+_umask = os.umask(0)
+os.umask(_umask)
+
+
 class LocalStorage(Storage):
 
+    supports_bytes_range = True
+
     def __init__(self, config):
         self._config = config
         self._root_path = self._config.storage_path
+        self._fsync = bool(self._config.get('storage_fsync', False))
+        self._sharding = bool(self._config.get('storage_sharding', False))
+
+    def _shard_path(self, path):
+        """Returns the path in the sharded layout, where the files of an image
+           are stored under images/<id[:2]>/<id[2:4]>/<id>/ rather than
+           images/<id>/.
+        """
+        parts = path.split('/', 2)
+        if len(parts) < 2 or parts[0] != self.images or len(parts[1]) <= 4:
+            return path
+        image_id = parts[1]
+        parts[1:2] = [image_id[:2], image_id[2:4], image_id]
+        return '/'.join(parts)
 
     def _init_path(self, path=None, create=False):
+        if path and self._sharding:
+            sharded = self._shard_path(path)
+            if sharded != path and create is False and \
+                    not os.path.exists(os.path.join(self._root_path,
+                                                    sharded)) and \
+                    os.path.exists(os.path.join(self._root_path, path)):
+                # Not migrated to the sharded layout yet
+                sharded = path
+            path = sharded
         path = os.path.join(self._root_path, path) if path else self._root_path
         if create is True:
             dirname = os.path.dirname(path)
-            if not os.path.exists(dirname):
+            try:
                 os.makedirs(dirname)
+            except OSError as e:
+                # Created by a concurrent write
+                if e.errno != errno.EEXIST:
+                    raise
         return path
 
+    def _lookup(self, path, func):
+        """Calls func with the physical path of path. While an image is being
+           sharded its files move from the flat layout to the sharded one,
+           so a miss is retried at the other places rather than being a 404.
+        """
+        paths = self._physical_paths(path)
+        if len(paths) > 1:
+            # The sharded path again, for a move done after trying it
+            paths.append(paths[0])
+        for p in paths[:-1]:
+            try:
+                return func(p)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return func(paths[-1])
+
+    @contextlib.contextmanager
+    def _open_atomic(self, path):
+        """Opens a temporary file next to path, which replaces path once
+           completely written. Readers never see a partial file.
+        """
+        dirname, basename = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.{0}.'.format(basename),
+                                        dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o666 & ~_umask)
+            os.rename(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self._fsync:
+            # Makes the rename itself durable
+            dir_fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
     @cache.get
     def get_content(self, path):
-        path = self._init_path(path)
-        with open(path, mode='r') as f:
+        with self._lookup(path, lambda p: open(p, mode='r')) as f:
             return f.read()
 
     @cache.put
     def put_content(self, path, content):
         path = self._init_path(path, create=True)
-        with open(path, mode='w') as f:
+        with self._open_atomic(path) as f:
             f.write(content)
         return path
 
-    def stream_read(self, path):
-        path = self._init_path(path)
-        with open(path, mode='rb') as f:
-            while True:
-                buf = f.read(self.buffer_size)
+    def stream_read(self, path, bytes_range=None):
+        with self._lookup(path, lambda p: open(p, mode='rb')) as f:
+            left = None
+            if bytes_range:
+                f.seek(bytes_range[0])
+                left = bytes_range[1] - bytes_range[0] + 1
+            while left is None or left > 0:
+                buf_size = self.buffer_size
+                if left is not None:
+                    # Make sure we don't read out of the range
+                    buf_size = min(buf_size, left)
+                    left -= buf_size
+                buf = f.read(buf_size)
                 if not buf:
                     break
                 yield buf
 
+    def open_file(self, path):
+        """Returns the file opened for reading, to be served as is."""
+        return self._lookup(path, lambda p: open(p, mode='rb'))
+
     def stream_write(self, path, fp):
         # Size is mandatory
         path = self._init_path(path, create=True)
-        with open(path, mode='wb') as f:
+        with self._open_atomic(path) as f:
             while True:
                 try:
                     buf = fp.read(self.buffer_size)
@@ -56,34 +151,114 @@ class LocalStorage(Storage):
                 except IOError:
                     break
 
+    @cache.move
+    def move(self, src, dst):
+        dst = self._init_path(dst, create=True)
+        os.rename(self._init_path(src), dst)
+
+    def stored_path(self, path):
+        """Returns the path the file is actually stored at, relative to the
+           storage root (the sharded one once the image is sharded).
+        """
+        return os.path.relpath(self._init_path(path), self._root_path)
+
+    def _physical_paths(self, path):
+        """Returns the paths path may be stored at, the sharded one first."""
+        paths = [os.path.join(self._root_path, path)]
+        if self._sharding:
+            sharded = self._shard_path(path)
+            if sharded != path:
+                paths.insert(0, os.path.join(self._root_path, sharded))
+        return paths
+
+    def _list_images(self, path):
+        # Image ids in the flat layout are longer than the shard names
+        ids = set()
+        for d in os.listdir(path):
+            if len(d) > 2:
+                ids.add(d)
+                yield d
+        for shard in os.listdir(path):
+            if len(shard) != 2:
+                continue
+            for sub in os.listdir(os.path.join(path, shard)):
+                for d in os.listdir(os.path.join(path, shard, sub)):
+                    if d not in ids:
+                        yield d
+
     def list_directory(self, path=None):
         prefix = path + '/'
-        path = self._init_path(path)
+        if self._sharding and path.rstrip('/') == self.images:
+            names = self._list_images(self._init_path(path))
+        else:
+            names = []
+            for p in self._physical_paths(path.rstrip('/')):
+                try:
+                    entries = os.listdir(p)
+                except OSError:
+                    continue
+                # An image being migrated has files at both places
+                names.extend(d for d in entries if d not in names)
 
         exists = False
-        for d in os.listdir(path):
+        for d in names:
             exists = True
             yield prefix + d
         if exists is False:
             # Raises OSError even when the directory is empty
             # (to be consistent with S3)
-            raise OSError('No such directory: \'{0}\''.format(path))
+            raise OSError('No such directory: \'{0}\''.format(
+                self._init_path(path)))
+
+    def unsharded_images(self):
+        """Yields the ids of the images still stored in the flat layout."""
+        path = self._init_path(self.images)
+        if not os.path.isdir(path):
+            return
+        for d in os.listdir(path):
+            if len(d) > 2:
+                yield d
+
+    def shard_image(self, image_id):
+        """Moves an image from the flat layout to its shard. The files which
+           have been written to the shard meanwhile are kept, they are newer.
+        """
+        path = '{0}/{1}'.format(self.images, image_id)
+        src = os.path.join(self._root_path, path)
+        dst = os.path.join(self._root_path, self._shard_path(path))
+        if src == dst:
+            return
+        self._init_path(self._shard_path(path), create=True)
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        for name in os.listdir(src):
+            try:
+                # Unlike rename, link never replaces an existing file
+                os.link(os.path.join(src, name), os.path.join(dst, name))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        shutil.rmtree(src)
 
     def exists(self, path):
-        path = self._init_path(path)
-        return os.path.exists(path)
+        paths = self._physical_paths(path)
+        # The sharded path again, for an image sharded meanwhile
+        return any(os.path.exists(p) for p in paths + paths[:1])
 
     @cache.remove
     def remove(self, path):
-        path = self._init_path(path)
-        if os.path.isdir(path):
-            shutil.rmtree(path)
-            return
-        try:
-            os.remove(path)
-        except OSError:
-            pass
+        for path in self._physical_paths(path):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
     def get_size(self, path):
-        path = self._init_path(path)
-        return os.path.getsize(path)
+        return self._lookup(path, os.path.getsize)
@@ -7,6 +7,8 @@ import logging
 
 import boto.s3.connection
 import boto.s3.key
+import gevent
+import gevent.pool
 
 import cache
 
@@ -18,8 +20,15 @@ logger = logging.getLogger(__name__)
 
 class S3Storage(BotoStorage):
 
+    # Number of attempts to upload each part of a multipart upload
+    part_retries = 3
+
     def __init__(self, config):
         BotoStorage.__init__(self, config)
+        # Minimum size of upload part size on S3 is 5MB
+        self._part_size = max(int(config.get('s3_part_size', 0)),
+                              5 * 1024 * 1024)
+        self._upload_concurrency = int(config.get('s3_upload_concurrency', 4))
 
     def makeConnection(self):
         return boto.s3.connection.S3Connection(
@@ -38,24 +47,47 @@ class S3Storage(BotoStorage):
             content, encrypt_key=(self._config.s3_encrypt is True))
         return path
 
+    def _upload_part(self, mp, buf, num_part, errors):
+        for attempt in range(self.part_retries):
+            io = StringIO.StringIO(buf)
+            try:
+                mp.upload_part_from_file(io, num_part)
+                return
+            except Exception as e:
+                logger.warn('S3Storage: upload of part {0} of {1} failed '
+                            '(attempt {2}): {3}'.format(num_part, mp.key_name,
+                                                        attempt + 1, e))
+                if attempt + 1 < self.part_retries:
+                    gevent.sleep(0.5 * 2 ** attempt)
+            finally:
+                io.close()
+        errors.append(e)
+
+    @cache.put_stream
     def stream_write(self, path, fp):
-        # Minimum size of upload part size on S3 is 5MB
-        buffer_size = 5 * 1024 * 1024
-        if self.buffer_size > buffer_size:
-            buffer_size = self.buffer_size
+        buffer_size = max(self._part_size, self.buffer_size)
         path = self._init_path(path)
         mp = self._boto_bucket.initiate_multipart_upload(
             path, encrypt_key=(self._config.s3_encrypt is True))
+        # The parts are uploaded while the next ones are read, spawn blocks
+        # when the pool is full so that at most `concurrency + 1' parts are
+        # held in memory.
+        pool = gevent.pool.Pool(self._upload_concurrency)
+        errors = []
         num_part = 1
-        while True:
+        while not errors:
             try:
                 buf = fp.read(buffer_size)
                 if not buf:
                     break
-                io = StringIO.StringIO(buf)
-                mp.upload_part_from_file(io, num_part)
-                num_part += 1
-                io.close()
             except IOError:
                 break
+            pool.spawn(self._upload_part, mp, buf, num_part, errors)
+            num_part += 1
+            buf = None
+        pool.join()
+        if errors:
+            mp.cancel_upload()
+            raise IOError('Could not upload to \'{0}\': {1}'.format(
+                path, errors[0]))
         mp.complete_upload()
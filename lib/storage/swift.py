@@ -1,16 +1,33 @@
 
-import cache
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import gevent.local
+import gevent.queue
 import swiftclient
 
+import cache
+
 from . import Storage
 
 
 class SwiftStorage(Storage):
 
+    supports_bytes_range = True
+    concurrency = 8
+
     def __init__(self, config):
-        self._swift_connection = self._create_swift_connection(config)
+        self._config = config
+        self._main_connection = self._create_swift_connection(config)
+        # Idle connections of the jobs run by map
+        self._connections = gevent.queue.Queue(maxsize=self.concurrency)
+        self._local = gevent.local.local()
         self._swift_container = config.swift_container
         self._root_path = config.get('storage_path', '/')
+        # Objects are limited to 5GB on Swift, bigger layers are segmented
+        self._segment_size = int(config.get('swift_segment_size',
+                                            1024 * 1024 * 1024))
 
     def _create_swift_connection(self, config):
         return swiftclient.client.Connection(
@@ -23,6 +40,44 @@ class SwiftStorage(Storage):
                 'region_name': config.get('swift_region_name')
             })
 
+    @property
+    def _swift_connection(self):
+        """The connection of the running job of map if any, a connection
+           cannot be used by concurrent requests.
+        """
+        return getattr(self._local, 'connection', self._main_connection)
+
+    def _get_connection(self):
+        try:
+            return self._connections.get_nowait()
+        except gevent.queue.Empty:
+            pass
+        connection = self._create_swift_connection(self._config)
+        # Reuses the token of the main connection rather than authenticating
+        connection.url = getattr(self._main_connection, 'url', None)
+        connection.token = getattr(self._main_connection, 'token', None)
+        return connection
+
+    def map(self, fn, items):
+        """Runs each job on a connection of its own, taken from a pool."""
+        def run(item):
+            previous = getattr(self._local, 'connection', None)
+            connection = self._get_connection()
+            self._local.connection = connection
+            try:
+                return fn(item)
+            finally:
+                if previous is None:
+                    del self._local.connection
+                else:
+                    self._local.connection = previous
+                try:
+                    self._connections.put_nowait(connection)
+                except gevent.queue.Full:
+                    # Enough idle connections already
+                    pass
+        return Storage.map(self, run, items)
+
     def _init_path(self, path=None):
         path = self._root_path + '/' + path if path else self._root_path
         # Openstack does not like paths starting with '/'
@@ -31,39 +86,84 @@ class SwiftStorage(Storage):
         return path
 
     @cache.get
-    def get_content(self, path, chunk_size=None):
+    def get_content(self, path):
         path = self._init_path(path)
         try:
             _, obj = self._swift_connection.get_object(
                 self._swift_container,
-                path,
-                resp_chunk_size=chunk_size)
+                path)
             return obj
         except Exception:
             raise IOError("Could not get content: {}".format(path))
 
     @cache.put
-    def put_content(self, path, content, chunk=None):
+    def put_content(self, path, content):
         path = self._init_path(path)
         try:
             self._swift_connection.put_object(self._swift_container,
                                               path,
-                                              content,
-                                              chunk_size=chunk)
+                                              content)
             return path
         except Exception:
             raise IOError("Could not put content: {}".format(path))
 
-    def stream_read(self, path):
+    def stream_read(self, path, bytes_range=None):
+        # Straight from Swift, the layers do not go through the cache
+        headers = None
+        if bytes_range:
+            headers = {'Range': 'bytes={0}-{1}'.format(*bytes_range)}
         try:
-            for buf in self.get_content(path, self.buffer_size):
+            _, obj = self._swift_connection.get_object(
+                self._swift_container,
+                self._init_path(path),
+                resp_chunk_size=self.buffer_size,
+                headers=headers)
+            for buf in obj:
                 yield buf
         except Exception:
             raise OSError(
                 "Could not read content from stream: {}".format(path))
 
+    def _put_segment(self, path, fp, headers=None):
+        try:
+            self._swift_connection.put_object(self._swift_container,
+                                              path,
+                                              fp,
+                                              chunk_size=self.buffer_size,
+                                              headers=headers)
+        except Exception:
+            raise IOError("Could not put content: {}".format(path))
+
+    @cache.put_stream
     def stream_write(self, path, fp):
-        self.put_content(path, fp, self.buffer_size)
+        """Layers bigger than the segment size are stored as a Dynamic Large
+           Object: the first segment is uploaded to the object itself and
+           moved next to the other ones when there is a second segment,
+           then the object is replaced by the manifest.
+        """
+        path = self._init_path(path)
+        segments_prefix = '{0}_segments/'.format(path)
+        segment = _SegmentReader(fp, self._segment_size)
+        self._put_segment(path, segment)
+        num_segment = 1
+        while not segment.eof:
+            # Make sure there is something left before adding a segment
+            buf = segment.read_next()
+            if not buf:
+                break
+            if num_segment == 1:
+                self._put_segment(
+                    '{0}{1:08d}'.format(segments_prefix, num_segment), '',
+                    headers={'X-Copy-From': '/{0}/{1}'.format(
+                        self._swift_container, path)})
+            num_segment += 1
+            segment = _SegmentReader(fp, self._segment_size, buf)
+            self._put_segment(
+                '{0}{1:08d}'.format(segments_prefix, num_segment), segment)
+        if num_segment > 1:
+            self._put_segment(path, '', headers={
+                'X-Object-Manifest': '{0}/{1}'.format(self._swift_container,
+                                                      segments_prefix)})
 
     def list_directory(self, path=None):
         try:
@@ -83,23 +183,106 @@ class SwiftStorage(Storage):
         except Exception:
             raise OSError("No such directory: {}".format(path))
 
+    def list_page(self, path, marker=None, limit=None, prefix=''):
+        """Lists a single page of up to limit names (10000 at most, the
+           maximum of a request).
+        """
+        root = self._init_path()
+        path = self._init_path(path)
+        if path and not path.endswith('/'):
+            path += '/'
+        limit = min(limit or 10000, 10000)
+        try:
+            _, directory = self._swift_connection.get_container(
+                container=self._swift_container,
+                prefix=path + prefix,
+                delimiter='/',
+                marker=self._init_path(marker) if marker else None,
+                limit=limit)
+        except Exception:
+            return [], None
+        names = []
+        for inode in directory:
+            # Sub directories are listed as their prefix only
+            name = inode.get('subdir') or inode['name']
+            names.append(name.rstrip('/').split('/')[-1])
+        marker = None
+        if len(directory) == limit:
+            # Out of the root, keeping the slash of a sub directory which
+            # would be listed again otherwise
+            marker = name[len(root):].lstrip('/')
+        return names, marker
+
+    def _head(self, path):
+        return self._swift_connection.head_object(self._swift_container,
+                                                  self._init_path(path))
+
+    @cache.exists
     def exists(self, path):
         try:
-            self.get_content(path)
+            self._head(path)
             return True
         except Exception:
             return False
 
     @cache.remove
     def remove(self, path):
-        path = self._init_path(path)
         try:
-            self._swift_connection.delete_object(self._swift_container, path)
+            manifest = self._head(path).get('x-object-manifest')
+            if manifest:
+                # Large object, its segments are removed as well
+                _, segments = self._swift_connection.get_container(
+                    container=self._swift_container,
+                    prefix=manifest.split('/', 1)[1],
+                    full_listing=True)
+                for segment in segments:
+                    self._swift_connection.delete_object(
+                        self._swift_container, segment['name'])
+            self._swift_connection.delete_object(self._swift_container,
+                                                 self._init_path(path))
         except Exception:
             pass
 
     def get_size(self, path):
         try:
-            return len(self.get_content(path))
+            return int(self._head(path)['content-length'])
         except Exception:
             raise OSError("Could not get file size: {}".format(path))
+
+
+class _SegmentReader(object):
+
+    """Reads at most `size' bytes out of fp, starting with `head'."""
+
+    def __init__(self, fp, size, head=''):
+        self._fp = fp
+        self._left = size - len(head)
+        self._head = head
+        self.eof = False
+
+    def read(self, size=-1):
+        if self._head:
+            buf, self._head = self._head, ''
+            return buf
+        if size < 0 or size > self._left:
+            size = self._left
+        if size == 0:
+            return ''
+        try:
+            buf = self._fp.read(size)
+        except IOError:
+            buf = ''
+        if not buf:
+            self.eof = True
+        self._left -= len(buf)
+        return buf
+
+    def read_next(self):
+        """Reads the first bytes following this segment."""
+        try:
+            buf = self._fp.read(64 * 1024)
+        except IOError:
+            buf = ''
+        if not buf:
+            self.eof = True
+        return buf
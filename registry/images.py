@@ -2,14 +2,18 @@
 import datetime
 import functools
 import logging
+import os
 import tarfile
-import tempfile
 import time
+import urllib
 
 import flask
 import simplejson as json
+import werkzeug.wsgi
 
+import cache
 import checksums
+import files_index
 import storage
 import toolkit
 
@@ -20,13 +24,73 @@ import storage.local
 
 store = storage.load()
 logger = logging.getLogger(__name__)
+# Maximum number of images listed in a single bulk request
+max_bulk_images = 100
+
+
+def get_image_metadata(image_id):
+    """Returns the meta-data record of the image (fetched once per request),
+       or None if records are disabled or the image does not have one yet.
+    """
+    if not cfg.metadata_record:
+        return
+    records = getattr(flask.g, 'image_metadata', None)
+    if records is None:
+        records = flask.g.image_metadata = {}
+    if image_id not in records:
+        try:
+            metadata = store.get_image_metadata(image_id)
+            # Records are created along with the image json
+            records[image_id] = metadata if 'json' in metadata else None
+        except IOError:
+            records[image_id] = None
+    return records[image_id]
+
+
+def put_image_metadata(image_id, checksum, size):
+    """Writes the meta-data record of the image once its push is complete,
+       it is never updated afterwards. Only the first piece of the ancestry
+       is kept, the next ones are shared with the parents.
+    """
+    if not cfg.metadata_record:
+        return
+    piece = json.loads(store.get_content(store.image_ancestry_path(image_id)))
+    store.put_image_metadata(
+        image_id, json=store.get_content(store.image_json_path(image_id)),
+        ancestry=piece, checksum=checksum, size=size)
+
+
+def get_layer_path(image_id):
+    if cfg.layer_dedup:
+        return store.get_image_layer_path(image_id)
+    return store.image_layer_path(image_id)
+
+
+def store_layer_blob(image_id, digest):
+    """Moves the layer to the blob of its content, unless the same content
+       is already stored. Only called once the checksum is verified.
+    """
+    layer_path = store.image_layer_path(image_id)
+    blob_path = store.blob_path(digest)
+    if store.exists(blob_path):
+        store.remove(layer_path)
+    else:
+        store.move(layer_path, blob_path)
+    store.link_image_layer(image_id, digest)
 
 
 def require_completion(f):
     """This make sure that the image push correctly finished."""
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        if store.exists(store.image_mark_path(kwargs['image_id'])):
+        metadata = get_image_metadata(kwargs['image_id'])
+        if metadata is not None:
+            # Records are only written once the push is complete
+            in_progress = metadata.get('inprogress')
+        else:
+            in_progress = store.exists(
+                store.image_mark_path(kwargs['image_id']))
+        if in_progress:
             return toolkit.api_error('Image is being uploaded, retry later')
         return f(*args, **kwargs)
     return wrapper
@@ -54,15 +118,66 @@ def set_cache_headers(f):
     return wrapper
 
 
+def _parse_bytes_range(size, headers):
+    """Returns the (start, end) range to serve out of a layer of `size' bytes
+       or None if the whole layer should be sent. Raises ValueError if the
+       range cannot be satisfied.
+    """
+    range_header = flask.request.headers.get('Range')
+    if not range_header:
+        return
+    if_range = flask.request.headers.get('If-Range')
+    if if_range and if_range != headers.get('Last-Modified'):
+        # The client's copy is outdated, it needs the whole layer
+        return
+    if not range_header.startswith('bytes=') or ',' in range_header:
+        # Multiple ranges are not supported, send the whole layer instead
+        logger.debug('_parse_bytes_range: Ignoring range header: '
+                     '{0}'.format(range_header))
+        return
+    parts = range_header[6:].split('-')
+    try:
+        if len(parts) != 2 or not (parts[0] or parts[1]):
+            raise ValueError
+        if not parts[0]:
+            # Suffix range, the last N bytes
+            start = max(size - int(parts[1]), 0)
+            end = size - 1
+        else:
+            start = int(parts[0])
+            end = int(parts[1]) if parts[1] else size - 1
+    except ValueError:
+        logger.debug('_parse_bytes_range: Invalid range header: '
+                     '{0}'.format(range_header))
+        return
+    if start >= size:
+        raise ValueError('Requested range not satisfiable')
+    if start > end:
+        return
+    return (start, min(end, size - 1))
+
+
+def _send_local_file(path, headers):
+    """Hands the file over to the WSGI server (wsgi.file_wrapper), which can
+       send it with sendfile when the Content-Length is known.
+    """
+    fp = store.open_file(path)
+    headers['Content-Length'] = str(os.fstat(fp.fileno()).st_size)
+    return flask.Response(
+        werkzeug.wsgi.wrap_file(flask.request.environ, fp, store.buffer_size),
+        headers=headers, direct_passthrough=True)
+
+
 def _get_image_layer(image_id, headers=None):
     if headers is None:
         headers = {}
     try:
         accel_uri_prefix = cfg.nginx_x_accel_redirect
-        path = store.image_layer_path(image_id)
+        path = get_layer_path(image_id)
         if accel_uri_prefix:
             if isinstance(store, storage.local.LocalStorage):
-                accel_uri = '/'.join([accel_uri_prefix, path])
+                accel_uri = '/'.join([accel_uri_prefix,
+                                      store.stored_path(path)])
                 headers['X-Accel-Redirect'] = accel_uri
                 logger.debug('send accelerated {0} ({1})'.format(
                     accel_uri, headers))
@@ -70,8 +185,35 @@ def _get_image_layer(image_id, headers=None):
             else:
                 logger.warn('nginx_x_accel_redirect config set,'
                             ' but storage is not LocalStorage')
-        return flask.Response(store.stream_read(path), headers=headers)
-    except IOError:
+        if cfg.storage_redirect:
+            redirect_url = store.content_redirect_url(path)
+            if redirect_url:
+                # The cache headers are not sent, the signed URL expires
+                logger.debug('redirect {0} to {1}'.format(path, redirect_url))
+                return flask.redirect(redirect_url, 302)
+            logger.warn('storage_redirect config set, but storage does '
+                        'not support redirects')
+        bytes_range = None
+        if store.supports_bytes_range:
+            headers['Accept-Ranges'] = 'bytes'
+            if 'Range' in flask.request.headers:
+                size = store.get_size(path)
+                try:
+                    bytes_range = _parse_bytes_range(size, headers)
+                except ValueError:
+                    return toolkit.api_error(
+                        'Requested range not satisfiable', 416,
+                        {'Content-Range': 'bytes */{0}'.format(size)})
+        if not bytes_range:
+            if isinstance(store, storage.local.LocalStorage):
+                return _send_local_file(path, headers)
+            return flask.Response(store.stream_read(path), headers=headers)
+        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            bytes_range[0], bytes_range[1], size)
+        headers['Content-Length'] = str(bytes_range[1] - bytes_range[0] + 1)
+        return flask.Response(store.stream_read(path, bytes_range),
+                              status=206, headers=headers)
+    except (IOError, OSError):
         return toolkit.api_error('Image not found', 404)
 
 
@@ -117,42 +259,60 @@ def put_image_layer(image_id):
         return toolkit.api_error('Image not found', 404)
     layer_path = store.image_layer_path(image_id)
     mark_path = store.image_mark_path(image_id)
-    if store.exists(layer_path) and not store.exists(mark_path):
+    stored_layer_path = get_layer_path(image_id)
+    exists = store.multi_exists([stored_layer_path, mark_path])
+    if exists[stored_layer_path] and not exists[mark_path]:
         return toolkit.api_error('Image already exists', 409)
     input_stream = flask.request.stream
     if flask.request.headers.get('transfer-encoding') == 'chunked':
         # Careful, might work only with WSGI servers supporting chunked
         # encoding (Gunicorn)
         input_stream = flask.request.environ['wsgi.input']
-    # compute checksums
+    # compute checksums while the layer is being stored
     csums = []
     sr = toolkit.SocketReader(input_stream)
-    tmp, store_hndlr = storage.temp_store_handler()
-    sr.add_handler(store_hndlr)
     h, sum_hndlr = checksums.simple_checksum_handler(json_data)
     sr.add_handler(sum_hndlr)
+    tarsum, tarsum_hndlr = checksums.tarsum_handler(json_data)
+    sr.add_handler(tarsum_hndlr)
+    if cfg.layer_dedup:
+        content_h, content_hndlr = checksums.content_checksum_handler()
+        sr.add_handler(content_hndlr)
+        # Releases the previous blob of a retried push
+        store.unlink_image_layer(image_id)
     store.stream_write(layer_path, sr)
     csums.append('sha256:{0}'.format(h.hexdigest()))
     try:
-        tmp.seek(0)
-        csums.append(checksums.compute_tarsum(tmp, json_data))
-        tmp.close()
+        csums.append(tarsum.compute())
+        # The files list comes for free along with the tarsum
+        store.put_content(store.image_files_path(image_id),
+                          files_index.build(tarsum.files))
     except (IOError, checksums.TarError) as e:
         logger.debug('put_image_layer: Error when computing tarsum '
                      '{0}'.format(e))
+        # Left over by a previous push, it is computed on demand instead
+        store.remove(store.image_files_path(image_id))
     try:
         checksum = store.get_content(store.image_checksum_path(image_id))
     except IOError:
         # We don't have a checksum stored yet, that's fine skipping the check.
         # Not removing the mark though, image is not downloadable yet.
         flask.session['checksum'] = csums
+        if cfg.layer_dedup:
+            # The layer is linked to its blob once the checksum is verified
+            flask.session['layer_digest'] = [
+                image_id, 'sha256:{0}'.format(content_h.hexdigest())]
         return toolkit.response()
     # We check if the checksums provided matches one the one we computed
     if checksum not in csums:
         logger.debug('put_image_layer: Wrong checksum')
         return toolkit.api_error('Checksum mismatch, ignoring the layer')
+    if cfg.layer_dedup:
+        store_layer_blob(image_id,
+                         'sha256:{0}'.format(content_h.hexdigest()))
     # Checksum is ok, we remove the marker
     store.remove(mark_path)
+    put_image_metadata(image_id, checksum, sr.bytes_read)
     return toolkit.response()
 
 
@@ -164,10 +324,12 @@ def put_image_checksum(image_id):
         return toolkit.api_error('Missing Image\'s checksum')
     if not flask.session.get('checksum'):
         return toolkit.api_error('Checksum not found in Cookie')
-    if not store.exists(store.image_json_path(image_id)):
-        return toolkit.api_error('Image not found', 404)
+    json_path = store.image_json_path(image_id)
     mark_path = store.image_mark_path(image_id)
-    if not store.exists(mark_path):
+    exists = store.multi_exists([json_path, mark_path])
+    if not exists[json_path]:
+        return toolkit.api_error('Image not found', 404)
+    if not exists[mark_path]:
         return toolkit.api_error('Cannot set this image checksum', 409)
     err = store_checksum(image_id, checksum)
     if err:
@@ -175,8 +337,16 @@ def put_image_checksum(image_id):
     if checksum not in flask.session.get('checksum', []):
         logger.debug('put_image_layer: Wrong checksum')
         return toolkit.api_error('Checksum mismatch')
+    layer_digest = flask.session.get('layer_digest')
+    if cfg.layer_dedup and layer_digest and layer_digest[0] == image_id:
+        store_layer_blob(image_id, layer_digest[1])
     # Checksum is ok, we remove the marker
     store.remove(mark_path)
+    try:
+        size = store.get_size(get_layer_path(image_id))
+    except OSError:
+        size = None
+    put_image_metadata(image_id, checksum, size)
     return toolkit.response()
 
 
@@ -213,22 +383,98 @@ def get_image_json(image_id, headers):
         return toolkit.api_error('Image not found', 404)
 
 
+def _load_image_json(image_id):
+    """Returns the json, layer size and checksum of an image out of its
+       separate files. Raises IOError if the image does not exist.
+    """
+    metadata = {
+        'json': store.get_content(store.image_json_path(image_id)),
+        'size': None,
+        'checksum': None
+    }
+    try:
+        metadata['size'] = store.get_size(get_layer_path(image_id))
+    except OSError:
+        pass
+    try:
+        metadata['checksum'] = store.get_content(
+            store.image_checksum_path(image_id))
+    except IOError:
+        pass
+    return metadata
+
+
 def _get_image_json(image_id, headers=None):
     if headers is None:
         headers = {}
-    try:
-        data = store.get_content(store.image_json_path(image_id))
-    except IOError:
+    metadata = get_image_metadata(image_id)
+    if metadata is None:
+        try:
+            metadata = _load_image_json(image_id)
+        except IOError:
+            return toolkit.api_error('Image not found', 404)
+    if metadata.get('size') is not None:
+        headers['X-Docker-Size'] = str(metadata['size'])
+    if metadata.get('checksum'):
+        headers['X-Docker-Checksum'] = metadata['checksum']
+    return toolkit.response(metadata['json'], headers=headers, raw=True)
+
+
+def _load_images_json(image_ids):
+    """Loads the json, layer size and checksum of several images at once,
+       the images which do not exist or are being uploaded are left out.
+    """
+    result = {}
+    if cfg.metadata_record:
+        records = store.multi_get(
+            [store.image_metadata_path(image_id) for image_id in image_ids])
+        missing = []
+        for image_id in image_ids:
+            record = records.get(store.image_metadata_path(image_id))
+            record = json.loads(record) if record is not None else {}
+            if 'json' not in record:
+                # Image pushed before the records were enabled
+                missing.append(image_id)
+            elif not record.get('inprogress'):
+                result[image_id] = record
+        image_ids = missing
+
+    def load(image_id):
+        # Runs outside of the request context, flask.g is not available
+        try:
+            if store.exists(store.image_mark_path(image_id)):
+                return
+            return _load_image_json(image_id)
+        except IOError:
+            return
+
+    for image_id, metadata in zip(image_ids, store.map(load, image_ids)):
+        if metadata is not None:
+            result[image_id] = metadata
+    return dict((image_id, {
+        'json': json.loads(metadata['json']),
+        'size': metadata.get('size'),
+        'checksum': metadata.get('checksum')
+    }) for image_id, metadata in result.iteritems())
+
+
+@app.route('/v1/images/json', methods=['GET'])
+@toolkit.requires_auth
+def get_images_json():
+    """Returns the json, layer size and checksum of the images listed in
+       the `ids' parameter (comma separated), typically a whole ancestry.
+    """
+    image_ids = [image_id for image_id
+                 in flask.request.args.get('ids', '').split(',') if image_id]
+    if not image_ids:
+        return toolkit.api_error('Missing image ids')
+    if len(image_ids) > max_bulk_images:
+        return toolkit.api_error('Too many images, the maximum is {0}'.format(
+            max_bulk_images))
+    repository = toolkit.get_repository()
+    if repository and store.is_private(*repository):
         return toolkit.api_error('Image not found', 404)
-    try:
-        size = store.get_size(store.image_layer_path(image_id))
-        headers['X-Docker-Size'] = str(size)
-    except OSError:
-        pass
-    checksum_path = store.image_checksum_path(image_id)
-    if store.exists(checksum_path):
-        headers['X-Docker-Checksum'] = store.get_content(checksum_path)
-    return toolkit.response(data, headers=headers, raw=True)
+    return toolkit.response(_load_images_json(image_ids))
 
 
 @app.route('/v1/images/<image_id>/ancestry', methods=['GET'])
@@ -236,22 +482,21 @@ def _get_image_json(image_id, headers=None):
 @require_completion
 @set_cache_headers
 def get_image_ancestry(image_id, headers):
+    metadata = get_image_metadata(image_id)
     try:
-        data = store.get_content(store.image_ancestry_path(image_id))
+        if metadata is not None:
+            ancestry = store.get_image_ancestry(image_id,
+                                                metadata['ancestry'])
+        else:
+            ancestry = store.get_image_ancestry(image_id)
     except IOError:
         return toolkit.api_error('Image not found', 404)
-    return toolkit.response(json.loads(data), headers=headers)
+    return toolkit.response(ancestry, headers=headers)
 
 
 def generate_ancestry(image_id, parent_id=None):
-    if not parent_id:
-        store.put_content(store.image_ancestry_path(image_id),
-                          json.dumps([image_id]))
-        return
-    data = store.get_content(store.image_ancestry_path(parent_id))
-    data = json.loads(data)
-    data.insert(0, image_id)
-    store.put_content(store.image_ancestry_path(image_id), json.dumps(data))
+    store.put_image_ancestry(image_id, parent_id,
+                             pieces=(cfg.ancestry_pieces is True))
 
 
 def check_images_list(image_id):
@@ -260,8 +505,13 @@ def check_images_list(image_id):
         # We only enforce this check when there is a repos name in the session
         # otherwise it means that the auth is disabled.
         return True
+    path = store.images_list_path(*full_repos_name.split('/'))
+    # The list the session was validated with is usually still in memory,
+    # the storage is only read when the image is not found in it
+    images_list = cache.recent_get(path)
+    if images_list is not None and image_id in json.loads(images_list):
+        return True
     try:
-        path = store.images_list_path(*full_repos_name.split('/'))
         images_list = json.loads(store.get_content(path))
     except IOError:
         return False
@@ -304,11 +554,15 @@ def put_image_json(image_id):
         return toolkit.api_error('This image does not belong to the '
                                  'repository')
     parent_id = data.get('parent')
-    if parent_id and not store.exists(store.image_json_path(data['parent'])):
-        return toolkit.api_error('Image depends on a non existing parent')
     json_path = store.image_json_path(image_id)
     mark_path = store.image_mark_path(image_id)
-    if store.exists(json_path) and not store.exists(mark_path):
+    paths = [json_path, mark_path]
+    if parent_id:
+        paths.append(store.image_json_path(parent_id))
+    exists = store.multi_exists(paths)
+    if parent_id and not exists[store.image_json_path(parent_id)]:
+        return toolkit.api_error('Image depends on a non existing parent')
+    if exists[json_path] and not exists[mark_path]:
         return toolkit.api_error('Image already exists', 409)
     # If we reach that point, it means that this is a new image or a retry
     # on a failed push
@@ -319,25 +573,57 @@ def put_image_json(image_id):
 
 
 def _get_image_files(image_id):
+    """Returns the files index of the layer, which is built out of the layer
+       or upgraded from the former json list the first time.
+    """
     image_files_path = store.image_files_path(image_id)
-    if store.exists(image_files_path):
-        return store.get_content(image_files_path)
-    image_path = store.image_layer_path(image_id)
-    files = []
-    with tempfile.TemporaryFile() as tmpf:
-        for buf in store.stream_read(image_path):
-            tmpf.write(buf)
-        tmpf.seek(0)
-        tarf = tarfile.open(mode='r|*', fileobj=tmpf)
-        for member in tarf.getmembers():
-            if not member.isfile():
-                continue
-            path = member.path
-            files.append(path[1:] if path.startswith('.') else path)
-        tarf.close()
-    files_data = json.dumps(files)
-    store.put_content(image_files_path, files_data)
-    return files_data
+    try:
+        data = store.get_content(image_files_path)
+    except IOError:
+        data = None
+    if data is not None:
+        if files_index.is_index(data):
+            return files_index.FilesIndex(data)
+        files = json.loads(data)
+    else:
+        # Layers pushed before the files lists were built at push time
+        tarsum = checksums.TarSum('')
+        for buf in store.stream_read(get_layer_path(image_id)):
+            tarsum.update(buf)
+        tarsum.compute()
+        files = tarsum.files
+    data = files_index.build(files)
+    store.put_content(image_files_path, data)
+    return files_index.FilesIndex(data)
+
+
+def _image_files_response(image_id, headers):
+    """Lists the files of the layer, optionally the `limit' ones starting
+       with `prefix' which come after `marker'.
+    """
+    args = flask.request.args
+    prefix = args.get('prefix', '').encode('utf-8')
+    marker = args.get('marker', '').encode('utf-8') or None
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError
+        except ValueError:
+            return toolkit.api_error('Invalid limit')
+    index = _get_image_files(image_id)
+    if limit is None:
+        return toolkit.response(index.list(prefix, marker), headers=headers)
+    files = index.list(prefix, marker, limit + 1)
+    if len(files) > limit:
+        files = files[:limit]
+        query = {'limit': limit, 'marker': files[-1]}
+        if prefix:
+            query['prefix'] = prefix
+        headers['Link'] = '<{0}?{1}>; rel="next"'.format(
+            flask.request.path, urllib.urlencode(query))
+    return toolkit.response(files, headers=headers)
 
 
 @app.route('/v1/private_images/<image_id>/files', methods=['GET'])
@@ -352,8 +638,7 @@ def get_private_image_files(image_id, headers):
     try:
         if not store.is_private(*repository):
             return toolkit.api_error('Image not found', 404)
-        data = _get_image_files(image_id)
-        return toolkit.response(data, headers=headers, raw=True)
+        return _image_files_response(image_id, headers)
     except IOError:
         return toolkit.api_error('Image not found', 404)
     except tarfile.TarError:
@@ -371,8 +656,7 @@ def get_image_files(image_id, headers):
             return toolkit.api_error('Image not found', 404)
         # If no auth token found, either standalone registry or privileged
         # access. In both cases, access is always "public".
-        data = _get_image_files(image_id)
-        return toolkit.response(data, headers=headers, raw=True)
+        return _image_files_response(image_id, headers)
     except IOError:
         return toolkit.api_error('Image not found', 404)
     except tarfile.TarError:
@@ -4,6 +4,7 @@ import logging
 import flask
 import simplejson as json
 
+import cache
 import signals
 import storage
 import toolkit
@@ -48,6 +49,64 @@ def get_properties(namespace, repo):
     })
 
 
+def read_tag_files(namespace, repository):
+    """Returns the tags of a repository read from the separate tag files.
+       Raises OSError if the repository does not exist.
+    """
+    paths = []
+    for fname in store.list_directory(store.tag_path(namespace, repository)):
+        tag_name = fname.split('/').pop()
+        if tag_name.startswith('tag_'):
+            paths.append(fname)
+    data = {}
+    for fname, content in store.multi_get(paths).iteritems():
+        data[fname.split('/').pop()[4:]] = content
+    return data
+
+
+def load_tags(namespace, repository):
+    """Returns the tags of a repository, out of the tags manifest (a single
+       object) when there is one. Raises OSError if the repository does not
+       exist.
+    """
+    try:
+        path = store.tags_manifest_path(namespace, repository)
+        return json.loads(store.get_content(path))
+    except IOError:
+        return read_tag_files(namespace, repository)
+
+
+def update_tags_manifest(namespace, repository, tag, value=None,
+                         attempts=3):
+    """Sets (or removes, if value is None) a tag in the tags manifest. The
+       manifest is read again once written: if a concurrent writer replaced
+       it with its own change only, the change is made again.
+    """
+    path = store.tags_manifest_path(namespace, repository)
+    for i in range(attempts):
+        try:
+            data = json.loads(store.get_content(path))
+        except IOError:
+            # Repository tagged before the manifest existed
+            try:
+                data = read_tag_files(namespace, repository)
+            except OSError:
+                data = {}
+        if value is None:
+            data.pop(tag, None)
+        else:
+            data[tag] = value
+        store.put_content(path, json.dumps(data))
+        try:
+            if json.loads(store.get_content(path)).get(tag) == value:
+                return
+        except IOError:
+            # Repository deleted meanwhile
+            return
+    logger.warn('update_tags_manifest: {0}/{1}: too many concurrent '
+                'changes'.format(namespace, repository))
+
+
 @app.route('/v1/repositories/<path:repository>/tags',
            methods=['GET'])
 @toolkit.parse_repository_name
@@ -55,14 +114,8 @@ def get_properties(namespace, repo):
 def get_tags(namespace, repository):
     logger.debug("[get_tags] namespace={0}; repository={1}".format(namespace,
                  repository))
-    data = {}
     try:
-        for fname in store.list_directory(store.tag_path(namespace,
-                                                         repository)):
-            tag_name = fname.split('/').pop()
-            if not tag_name.startswith('tag_'):
-                continue
-            data[tag_name[4:]] = store.get_content(fname)
+        data = load_tags(namespace, repository)
     except OSError:
         return toolkit.api_error('Repository not found', 404)
     return toolkit.response(data)
@@ -100,6 +153,7 @@ def put_tag(namespace, repository, tag):
     if not store.exists(store.image_json_path(data)):
         return toolkit.api_error('Image not found', 404)
     store.put_content(store.tag_path(namespace, repository, tag), data)
+    update_tags_manifest(namespace, repository, tag, data)
     sender = flask.current_app._get_current_object()
     signals.tag_created.send(sender, namespace=namespace,
                              repository=repository, tag=tag, value=data)
@@ -115,6 +169,7 @@ def delete_tag(namespace, repository, tag):
                  namespace, repository, tag))
     try:
         store.remove(store.tag_path(namespace, repository, tag))
+        update_tags_manifest(namespace, repository, tag)
         sender = flask.current_app._get_current_object()
         signals.tag_deleted.send(sender, namespace=namespace,
                                  repository=repository, tag=tag)
@@ -131,7 +186,12 @@ def delete_repository(namespace, repository):
     logger.debug("[delete_repository] namespace={0}; repository={1}".format(
                  namespace, repository))
     try:
+        # Removed on its own so that it's dropped from the cache as well
+        store.remove(store.tags_manifest_path(namespace, repository))
         store.remove(store.tag_path(namespace, repository))
+        # The images list is gone along with the repository, it must be
+        # written again on the next push
+        cache.delete_digest(store.images_list_path(namespace, repository))
         #TODO(samalba): Trigger tags_deleted signals
     except OSError:
         return toolkit.api_error('Repository not found', 404)
@@ -1,27 +1,37 @@
 import base64
+import cookielib
 import functools
+import hashlib
+import hmac
 import logging
 import random
 import re
 import string
+import time
 import urllib
 
 import flask
 import requests
+import requests.adapters
 import rsa
 import simplejson as json
 
+import cache
 import config
 import storage
 
 
 logger = logging.getLogger(__name__)
+_index_session = None
+# Claims of the signed tokens verified, until they expire
+_signed_tokens = cache.LRUCache(10000, 16 * 1024 * 1024)
 
 
 class SocketReader(object):
     def __init__(self, fp):
         self._fp = fp
         self.handlers = []
+        self.bytes_read = 0
 
     def add_handler(self, handler):
         self.handlers.append(handler)
@@ -30,6 +40,7 @@ class SocketReader(object):
         buf = self._fp.read(n)
         if not buf:
             return ''
+        self.bytes_read += len(buf)
         for handler in self.handlers:
             handler(buf)
         return buf
@@ -67,6 +78,76 @@ def check_session():
     return session.get('auth') is True
 
 
+def index_session():
+    """Returns the HTTP session shared by all the calls to the Index, its
+       connections are pooled and kept alive. It is shared by the requests
+       of all the users, the cookies set by the Index are not kept.
+    """
+    global _index_session
+    if _index_session is None:
+        cfg = config.load()
+        pool_size = int(cfg.get('index_pool_size', 10))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        session = requests.Session()
+        session.cookies.set_policy(
+            cookielib.DefaultCookiePolicy(allowed_domains=[]))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _index_session = session
+    return _index_session
+
+
+def index_request(method, url, **kwargs):
+    """Sends a request to the Index through the shared session. Connection
+       errors and server errors are retried with an exponential backoff.
+    """
+    cfg = config.load()
+    retries = int(cfg.get('index_retries', 2))
+    backoff = float(cfg.get('index_retry_backoff', 0.1))
+    kwargs.setdefault('timeout', float(cfg.get('index_timeout', 10)))
+    session = index_session()
+    pool = session.get_adapter(url).poolmanager.connection_from_url(url)
+    for attempt in range(retries + 1):
+        resp = error = None
+        connections = pool.num_connections
+        start = time.time()
+        try:
+            resp = session.request(method, url, **kwargs)
+            status = resp.status_code
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            error = e
+            status = e.__class__.__name__
+        # A new connection means a new TCP (and TLS) handshake
+        logger.debug('index_request: {0} {1} returned {2} in {3:.1f}ms '
+                     '({4} connection)'.format(
+                         method, url, status, (time.time() - start) * 1000,
+                         'new' if pool.num_connections > connections
+                         else 'reused'))
+        if resp is not None and resp.status_code < 500:
+            break
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    if resp is None:
+        raise error
+    return resp
+
+
+def update_images_list(namespace, repository, images_list):
+    """Writes the list of the images of the repository given by the Index,
+       unless it is the same as the one written last.
+    """
+    store = storage.load()
+    path = store.images_list_path(namespace, repository)
+    data = json.dumps(images_list)
+    digest = hashlib.sha256(data).hexdigest()
+    if cache.get_digest(path) != digest:
+        store.put_content(path, data)
+        cache.set_digest(path, digest)
+    cache.recent_set(path, data)
+
+
 def validate_token(auth):
     full_repos_name = auth.get('repository', '').split('/')
     if len(full_repos_name) != 2:
@@ -80,19 +161,27 @@ def validate_token(auth):
     url = '{0}/v1/repositories/{1}/{2}/images'.format(index_endpoint,
                                                       full_repos_name[0],
                                                       full_repos_name[1])
-    headers = {'Authorization': flask.request.headers.get('authorization')}
-    resp = requests.get(url, verify=True, headers=headers)
+    authorization = flask.request.headers.get('authorization')
+    token_key = hashlib.sha256(authorization).hexdigest()
+    valid = cache.get_token(token_key)
+    if valid is not None:
+        logger.debug('validate_token: Cached result {0}'.format(valid))
+        return valid
+    headers = {'Authorization': authorization}
+    resp = index_request('GET', url, verify=True, headers=headers)
     logger.debug('validate_token: Index returned {0}'.format(resp.status_code))
+    if resp.status_code in (401, 403):
+        cache.set_token(token_key, False)
     if resp.status_code != 200:
         return False
-    store = storage.load()
     try:
         images_list = [i['id'] for i in json.loads(resp.text)]
-        store.put_content(store.images_list_path(*full_repos_name),
-                          json.dumps(images_list))
+        update_images_list(full_repos_name[0], full_repos_name[1],
+                           images_list)
     except json.JSONDecodeError:
         logger.debug('validate_token: Wrong format for images_list')
         return False
+    cache.set_token(token_key, True)
     return True
 
 
@@ -115,20 +204,10 @@ def is_ssl():
 _auth_exp = re.compile(r'(\w+)[:=][\s"]?([^",]+)"?')
 
 
-def check_token(args):
-    cfg = config.load()
-    if cfg.disable_token_auth is True or cfg.standalone is not False:
-        return True
-    auth = flask.request.headers.get('authorization', '')
-    if auth.split(' ')[0].lower() != 'token':
-        logger.debug('check_token: Invalid token format')
-        return False
-    logger.debug('args = {0}'.format(args))
-    logger.debug('Auth Token = {0}'.format(auth))
-    auth = dict(_auth_exp.findall(auth))
-    logger.debug('auth = {0}'.format(auth))
-    if not auth:
-        return False
+def check_token_access(auth, args):
+    """Checks the repository and the access granted by a token against the
+       request.
+    """
     if 'namespace' in args and 'repository' in args:
         # We're authorizing an action on a repository,
         # let's check that it matches the repos name provided in the token
@@ -150,6 +229,103 @@ def check_token(args):
     if access == 'delete' and flask.request.method != 'DELETE':
         logger.debug('check_token: Wrong access value in the token')
         return False
+    return True
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _compare_digest(a, b):
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def verify_signed_token(token, key):
+    """Returns the claims of a JWT signed with HMAC-SHA256 (HS256), or None
+       if the token is invalid or expired. The `exp' claim is mandatory.
+    """
+    try:
+        header, payload, signature = token.encode('ascii').split('.')
+        expected = hmac.new(key, '{0}.{1}'.format(header, payload),
+                            hashlib.sha256).digest()
+        if not _compare_digest(_b64decode(signature), expected):
+            return
+        if json.loads(_b64decode(header)).get('alg') != 'HS256':
+            return
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, TypeError, AttributeError):
+        return
+    if not isinstance(claims, dict) or \
+            not isinstance(claims.get('exp'), (int, long, float)) or \
+            claims['exp'] <= time.time():
+        return
+    return claims
+
+
+def get_signed_token():
+    """Returns the claims of the signed token of the request, None if it
+       does not have a valid one. Verified tokens are memoized until they
+       expire.
+    """
+    if hasattr(flask.g, 'signed_token'):
+        return flask.g.signed_token
+    claims = None
+    key = config.load().signed_token_key
+    auth = flask.request.headers.get('authorization', '')
+    if key and auth[:7].lower() == 'bearer ':
+        token = auth[7:].strip()
+        claims = _signed_tokens.get(token)
+        if claims is not None:
+            claims = json.loads(claims)
+        else:
+            claims = verify_signed_token(token, str(key))
+            if claims is not None:
+                _signed_tokens.set(token, json.dumps(claims),
+                                   claims['exp'] - time.time())
+    flask.g.signed_token = claims
+    return claims
+
+
+def check_signed_token(args):
+    """Fast path checking a token signed with `signed_token_key' locally,
+       neither the session nor the Index are involved. Unlike the Index
+       tokens, both the repository and the access must be given.
+    """
+    claims = get_signed_token()
+    if claims is None:
+        return False
+    if claims.get('access') not in ('read', 'write', 'delete'):
+        logger.debug('check_signed_token: Missing or invalid access')
+        return False
+    if len(str(claims.get('repository') or '').split('/')) != 2:
+        logger.debug('check_signed_token: Missing or invalid repository')
+        return False
+    return check_token_access(claims, args)
+
+
+def check_token(args):
+    cfg = config.load()
+    if cfg.disable_token_auth is True or cfg.standalone is not False:
+        return True
+    auth = flask.request.headers.get('authorization', '')
+    if auth.split(' ')[0].lower() != 'token':
+        logger.debug('check_token: Invalid token format')
+        return False
+    logger.debug('args = {0}'.format(args))
+    logger.debug('Auth Token = {0}'.format(auth))
+    auth = dict(_auth_exp.findall(auth))
+    logger.debug('auth = {0}'.format(auth))
+    if not auth:
+        return False
+    if not check_token_access(auth, args):
+        return False
     if validate_token(auth) is False:
         return False
     # Token is valid, we create a session
@@ -197,8 +373,8 @@ def parse_content_signature(s):
 def requires_auth(f):
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        if check_signature() is True or check_session() is True \
-                or check_token(kwargs) is True:
+        if check_signed_token(kwargs) is True or check_signature() is True \
+                or check_session() is True or check_token(kwargs) is True:
             return f(*args, **kwargs)
         headers = {'WWW-Authenticate': 'Token'}
         return api_error('Requires authorization', 401, headers)
@@ -225,7 +401,8 @@ def parse_repository_name(f):
         else:
             (namespace, repository) = parts
         repository = urllib.quote_plus(repository)
-        return f(namespace, repository, *args, **kwargs)
+        # Passed by name, requires_auth checks them against the token
+        return f(namespace=namespace, repository=repository, *args, **kwargs)
     return wrapper
 
 
@@ -233,7 +410,7 @@ def get_repository():
     auth = flask.request.headers.get('authorization', '')
     if not auth:
         return
-    auth = dict(_auth_exp.findall(auth))
+    auth = get_signed_token() or dict(_auth_exp.findall(auth))
     repository = auth.get('repository')
     if repository is None:
         return ('', '')
@@ -9,13 +9,17 @@ import simplejson as json
 root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(os.path.join(root_path, 'lib'))
 
+import config
 import storage
 
 
+cfg = config.load()
 store = storage.load()
 images_cache = {}
 ancestry_cache = {}
 dry_run = True
+# Number of images whose files are looked up at once
+batch_size = 100
 
 
 def warning(msg):
@@ -54,7 +58,10 @@ def create_image_ancestry(image_id):
     ancestry_path = store.image_ancestry_path(image_id)
     if dry_run is False:
         if not store.exists(ancestry_path):
-            store.put_content(ancestry_path, json.dumps(ancestry))
+            # The parents' ancestry has been generated above
+            parent_id = ancestry[1] if len(ancestry) > 1 else None
+            store.put_image_ancestry(image_id, parent_id,
+                                     pieces=(cfg.ancestry_pieces is True))
     ancestry_cache[image_id] = True
     print ('Generated ancestry (size: {0}) '
            'for image_id: {1}'.format(len(ancestry), image_id))
@@ -74,7 +81,7 @@ def resolve_all_tags():
 
 
 def compute_image_checksum(image_id, json_data):
-    layer_path = store.image_layer_path(image_id)
+    layer_path = store.get_image_layer_path(image_id)
     if not store.exists(layer_path):
         warning('{0} is broken (no layer)'.format(image_id))
         return
@@ -89,32 +96,42 @@ def compute_image_checksum(image_id, json_data):
     store.put_content(checksum_path, checksum)
 
 
-def load_image_json(image_id):
+def check_image_json(image_id, json_data):
+    """Returns json_data if it is the valid json of the image."""
     try:
-        json_path = store.image_json_path(image_id)
-        json_data = store.get_content(json_path)
+        if json_data is None:
+            raise ValueError('No json')
         info = json.loads(json_data)
         if image_id != info['id']:
             warning('{0} is broken (json\'s id mismatch)'.format(image_id))
             return
         return json_data
-    except (IOError, json.JSONDecodeError):
+    except ValueError:
+        # JSONDecodeError is a ValueError
         warning('{0} is broken (invalid json)'.format(image_id))
 
 
 def compute_missing_checksums():
-    for image in store.list_directory(store.images):
-        image_id = image.split('/').pop()
-        if image_id not in ancestry_cache:
-            warning('{0} is orphan'.format(image_id))
-        json_data = load_image_json(image_id)
-        if not json_data:
-            continue
-        checksum_path = store.image_checksum_path(image_id)
-        if store.exists(checksum_path):
-            # Checksum already there, skipping
-            continue
-        compute_image_checksum(image_id, json_data)
+    image_ids = [image.split('/').pop()
+                 for image in store.list_directory_parallel(store.images)]
+    for i in xrange(0, len(image_ids), batch_size):
+        batch = image_ids[i:i + batch_size]
+        # The files of a whole batch are looked up concurrently
+        jsons = store.multi_get(
+            [store.image_json_path(image_id) for image_id in batch])
+        checksums = store.multi_exists(
+            [store.image_checksum_path(image_id) for image_id in batch])
+        for image_id in batch:
+            if image_id not in ancestry_cache:
+                warning('{0} is orphan'.format(image_id))
+            json_data = check_image_json(
+                image_id, jsons.get(store.image_json_path(image_id)))
+            if not json_data:
+                continue
+            if checksums[store.image_checksum_path(image_id)]:
+                # Checksum already there, skipping
+                continue
+            compute_image_checksum(image_id, json_data)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+import simplejson as json
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(root_path, 'lib'))
+
+import checksums
+import files_index
+import storage
+
+
+store = storage.load()
+dry_run = True
+
+
+def warning(msg):
+    print >>sys.stderr, '# Warning: ' + msg
+
+
+def load_files_list(image_id):
+    """Lists the files of the layer of an image, streaming it once."""
+    tarsum = checksums.TarSum('')
+    try:
+        for buf in store.stream_read(store.get_image_layer_path(image_id)):
+            tarsum.update(buf)
+        tarsum.compute()
+    except (IOError, OSError):
+        warning('{0} is broken (no layer)'.format(image_id))
+        return
+    except checksums.TarError as e:
+        warning('{0} is broken (invalid layer: {1})'.format(image_id, e))
+        return
+    return tarsum.files
+
+
+def create_missing_files_lists():
+    for image in store.list_directory_parallel(store.images):
+        image_id = image.split('/').pop()
+        files_path = store.image_files_path(image_id)
+        files = None
+        if store.exists(files_path):
+            data = store.get_content(files_path)
+            if files_index.is_index(data):
+                # Files index already there, skipping
+                continue
+            # Former json list, converted to an index
+            files = json.loads(data)
+        elif store.exists(store.image_mark_path(image_id)):
+            # Push in progress, the files list comes with the layer
+            continue
+        print 'Writing files index for {0}'.format(image_id)
+        if dry_run:
+            continue
+        if files is None:
+            files = load_files_list(image_id)
+        if files is not None:
+            store.put_content(files_path, files_index.build(files))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--seriously':
+        dry_run = False
+    create_missing_files_lists()
+    if dry_run:
+        print '-------'
+        print '/!\ No modification has been made (dry-run)'
+        print '/!\ In order to apply the changes, re-run with:'
+        print '$ {0} --seriously'.format(sys.argv[0])
+    else:
+        print '# Changes applied.'
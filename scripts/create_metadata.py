@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+import simplejson as json
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(root_path, 'lib'))
+
+import storage
+
+
+store = storage.load()
+dry_run = True
+
+
+def warning(msg):
+    print >>sys.stderr, '# Warning: ' + msg
+
+
+def load_image_metadata(image_id):
+    """Builds the meta-data record of an image out of its separate files."""
+    if store.exists(store.image_mark_path(image_id)):
+        # Written once the push is complete
+        return
+    try:
+        json_data = store.get_content(store.image_json_path(image_id))
+        ancestry = json.loads(
+            store.get_content(store.image_ancestry_path(image_id)))
+    except (IOError, json.JSONDecodeError):
+        warning('{0} is broken (invalid json or ancestry)'.format(image_id))
+        return
+    metadata = {
+        'json': json_data,
+        'ancestry': ancestry,
+        'checksum': None,
+        'size': None
+    }
+    checksum_path = store.image_checksum_path(image_id)
+    if store.exists(checksum_path):
+        metadata['checksum'] = store.get_content(checksum_path)
+    try:
+        metadata['size'] = store.get_size(store.get_image_layer_path(image_id))
+    except OSError:
+        pass
+    return metadata
+
+
+def create_missing_metadata():
+    for image in store.list_directory_parallel(store.images):
+        image_id = image.split('/').pop()
+        if store.exists(store.image_metadata_path(image_id)):
+            # Record already there, skipping
+            continue
+        metadata = load_image_metadata(image_id)
+        if not metadata:
+            continue
+        print 'Writing meta-data record for {0}'.format(image_id)
+        if dry_run is False:
+            store.put_image_metadata(image_id, **metadata)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--seriously':
+        dry_run = False
+    create_missing_metadata()
+    if dry_run:
+        print '-------'
+        print '/!\ No modification has been made (dry-run)'
+        print '/!\ In order to apply the changes, re-run with:'
+        print '$ {0} --seriously'.format(sys.argv[0])
+    else:
+        print '# Changes applied.'
@@ -29,9 +29,7 @@ def walk_all_tags():
 
 def walk_ancestry(image_id):
     try:
-        ancestry_data = store.get_content(store.image_ancestry_path(image_id))
-        ancestry = json.loads(ancestry_data)
-        return iter(ancestry)
+        return iter(store.get_image_ancestry(image_id))
     except IOError:
         print 'Ancestry file for {0} is missing'.format(image_id)
     return []
@@ -96,6 +96,9 @@ def import_tags(sess, store):
             if store.exists(path):
                 continue
             dest = store.put_content(path, image_id)
+            # The tag files are listed until the next tag write
+            store.remove(store.tags_manifest_path(repos_namespace,
+                                                  repos_name))
             print '{0} -> {1}'.format(dest, image_id)
         except AttributeError as e:
             print '# Warning: {0}'.format(e)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(root_path, 'lib'))
+
+import config
+import storage
+
+
+store = storage.load()
+dry_run = True
+
+
+def shard_images():
+    """Moves the images of a local storage to the sharded layout, the
+       registry keeps serving them while they are being moved.
+    """
+    if not isinstance(store, storage.LocalStorage):
+        print >>sys.stderr, 'Only the local storage can be sharded'
+        sys.exit(1)
+    if not config.load().storage_sharding:
+        print >>sys.stderr, 'Set storage_sharding in the configuration first'
+        sys.exit(1)
+    for image_id in store.unsharded_images():
+        print 'Moving {0} to its shard'.format(image_id)
+        if dry_run:
+            continue
+        store.shard_image(image_id)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--seriously':
+        dry_run = False
+    shard_images()
+    if dry_run:
+        print '-------'
+        print '/!\ No modification has been made (dry-run)'
+        print '/!\ In order to apply the changes, re-run with:'
+        print '$ {0} --seriously'.format(sys.argv[0])
+    else:
+        print '# Changes applied.'
@@ -0,0 +1,175 @@
+import unittest
+
+import cache
+import storage
+
+import utils.mock_redis
+
+
+class Store(storage.Storage):
+
+    """In-memory storage counting the reads which reach it."""
+
+    def __init__(self):
+        self.files = {}
+        self.reads = 0
+
+    def get_content(self, path):
+        self.reads += 1
+        if path not in self.files:
+            raise IOError('No such file: {0}'.format(path))
+        return self.files[path]
+
+    def put_content(self, path, content):
+        self.files[path] = content
+
+    def exists(self, path):
+        return path in self.files
+
+    def remove(self, path):
+        for key in self.files.keys():
+            if key == path or key.startswith(path + '/'):
+                del self.files[key]
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        self._local_cache = cache.local_cache
+        cache.local_cache = cache.LRUCache(100, 1024 * 1024)
+        # The decorators are only applied when the cache is enabled
+        self.get = cache.get(Store.get_content.im_func)
+        self.store = Store()
+        self.json_path = self.store.image_json_path('abcdef')
+        self.mark_path = self.store.image_mark_path('abcdef')
+
+    def tearDown(self):
+        cache.local_cache = self._local_cache
+
+    def test_complete_image(self):
+        self.store.files[self.json_path] = 'json'
+        self.assertEqual(self.get(self.store, self.json_path), 'json')
+        self.assertEqual(self.get(self.store, self.json_path), 'json')
+        self.assertEqual(self.store.reads, 1)
+
+    def test_push_in_progress(self):
+        self.store.files[self.mark_path] = 'true'
+        self.store.files[self.json_path] = 'json'
+        self.assertEqual(self.get(self.store, self.json_path), 'json')
+        # Rewritten by a retried push on another worker
+        self.store.files[self.json_path] = 'retried'
+        self.assertEqual(self.get(self.store, self.json_path), 'retried')
+        del self.store.files[self.mark_path]
+        self.assertEqual(self.get(self.store, self.json_path), 'retried')
+        self.assertEqual(self.get(self.store, self.json_path), 'retried')
+        self.assertEqual(self.store.reads, 3)
+
+    def test_mutable_paths(self):
+        path = self.store.images_list_path('foo', 'bar')
+        self.store.files[path] = '[]'
+        self.get(self.store, path)
+        self.get(self.store, path)
+        self.assertEqual(self.store.reads, 2)
+
+    def test_lru(self):
+        lru = cache.LRUCache(2, 10)
+        lru.set('a', '1234')
+        lru.set('b', '1234')
+        lru.get('a')
+        lru.set('c', '1234')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), '1234')
+        # Bounded in size as well
+        lru.set('d', '12345678')
+        self.assertEqual(len(lru), 1)
+        lru.set('e', '1234', ttl=-1)
+        self.assertIsNone(lru.get('e'))
+
+
+class TestRedisCache(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (cache.redis_conn, cache.cache_prefix,
+                       cache.exists_prefix, cache.exists_index_prefix)
+        cache.redis_conn = utils.mock_redis.StrictRedis()
+        cache.cache_prefix = 'cache_path:'
+        cache.exists_prefix = 'cache_exists:'
+        cache.exists_index_prefix = 'cache_exists_index:'
+        self.store = Store()
+        self.checks = 0
+
+        def exists(store, path):
+            self.checks += 1
+            return Store.exists.im_func(store, path)
+        # The decorators are only applied when the cache is enabled
+        self.exists = cache.exists(exists)
+        self.put = cache.put(Store.put_content.im_func)
+        self.remove = cache.remove(Store.remove.im_func)
+
+    def tearDown(self):
+        (cache.redis_conn, cache.cache_prefix,
+         cache.exists_prefix, cache.exists_index_prefix) = self._saved
+
+    def test_exists(self):
+        path = 'repositories/foo/bar/tag_latest'
+        self.assertFalse(self.exists(self.store, path))
+        self.assertFalse(self.exists(self.store, path))
+        self.assertEqual(self.checks, 1)
+        # Negative answers are dropped when the path is written
+        self.put(self.store, path, 'abc')
+        self.assertTrue(self.exists(self.store, path))
+        self.assertTrue(self.exists(self.store, path))
+        self.assertEqual(self.checks, 2)
+        self.remove(self.store, path)
+        self.assertFalse(self.exists(self.store, path))
+
+    def test_remove_directory(self):
+        directory = 'repositories/foo/bar'
+        tag_path = directory + '/tag_latest'
+        missing_path = directory + '/_private'
+        self.put(self.store, tag_path, 'abc')
+        self.assertTrue(self.exists(self.store, tag_path))
+        self.assertFalse(self.exists(self.store, missing_path))
+        self.remove(self.store, directory)
+        self.assertFalse(self.exists(self.store, tag_path))
+        # Written behind the cache's back, by another registry
+        self.store.files[missing_path] = 'true'
+        self.assertTrue(self.exists(self.store, missing_path))
+        self.assertEqual(self.checks, 4)
+
+    def test_move(self):
+        src = 'images/abcdef/layer'
+        dst = 'blobs/sha256/abcdef/layer'
+        self.put(self.store, src, 'abc')
+        self.assertTrue(self.exists(self.store, src))
+        self.assertFalse(self.exists(self.store, dst))
+
+        def move(store, src, dst):
+            store.files[dst] = store.files.pop(src)
+        cache.move(move)(self.store, src, dst)
+        self.assertFalse(self.exists(self.store, src))
+        self.assertTrue(self.exists(self.store, dst))
+        self.assertEqual(self.checks, 4)
+
+    def test_index_parent_only(self):
+        path = 'repositories/foo/bar/tag_latest'
+        self.exists(self.store, path)
+        self.exists(self.store, 'images/abcdef')
+        redis = cache.redis_conn
+        self.assertEqual(redis.smembers(cache.exists_index_key(
+            'repositories/foo/bar')), set([path]))
+        # Never removed, such sets would grow with each repository or image
+        for directory in ('repositories', 'repositories/foo', 'images'):
+            self.assertEqual(
+                redis.smembers(cache.exists_index_key(directory)), set())
+
+    def test_put_concurrent_exists(self):
+        path = 'repositories/foo/bar/tag_latest'
+
+        def put_content(store, path, content):
+            # Checked by another request while the file is being written
+            self.assertFalse(self.exists(store, path))
+            store.files[path] = content
+        cache.put(put_content)(self.store, path, 'abc')
+        self.assertTrue(self.exists(self.store, path))
+
@@ -0,0 +1,59 @@
+import cStringIO as StringIO
+import random
+import tarfile
+import unittest
+
+import checksums
+
+
+class TestChecksums(unittest.TestCase):
+
+    def gen_layer(self, fmt=tarfile.GNU_FORMAT, compression=''):
+        io = StringIO.StringIO()
+        tar = tarfile.open(mode='w:' + compression, fileobj=io, format=fmt)
+        for i in range(20):
+            member = tarfile.TarInfo('dir/{0}/file'.format('x' * i * 10))
+            data = ''.join(chr(random.randint(0, 255))
+                           for x in range(random.randint(0, 2048)))
+            member.size = len(data)
+            tar.addfile(member, StringIO.StringIO(data))
+            member = tarfile.TarInfo('link{0}'.format(i))
+            member.type = tarfile.SYMTYPE
+            member.linkname = 'y' * i * 10
+            tar.addfile(member)
+        tar.close()
+        return io.getvalue()
+
+    def stream_tarsum(self, data, json_data, chunk_size):
+        tarsum, handler = checksums.tarsum_handler(json_data)
+        for i in range(0, len(data), chunk_size):
+            handler(data[i:i + chunk_size])
+        return tarsum.compute()
+
+    def test_tarsum_handler(self):
+        json_data = '{"id": "foobar"}'
+        for fmt in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+            for compression in ('', 'gz', 'bz2'):
+                data = self.gen_layer(fmt, compression)
+                expected = checksums.compute_tarsum(StringIO.StringIO(data),
+                                                    json_data)
+                for chunk_size in (511, 4096, 128 * 1024):
+                    self.assertEqual(
+                        expected,
+                        self.stream_tarsum(data, json_data, chunk_size))
+
+    def test_tarsum_handler_errors(self):
+        # Empty layers still get a tarsum, invalid ones raise
+        self.assertEqual(checksums.compute_tarsum(StringIO.StringIO(''), ''),
+                         self.stream_tarsum('', '', 512))
+        self.assertRaises(checksums.TarError, self.stream_tarsum,
+                          'a' * 1024, '', 512)
+        # Layer truncated in the middle of a member
+        io = StringIO.StringIO()
+        tar = tarfile.open(mode='w', fileobj=io)
+        member = tarfile.TarInfo('foo')
+        member.size = 4096
+        tar.addfile(member, StringIO.StringIO('a' * member.size))
+        tar.close()
+        self.assertRaises(checksums.TarError, self.stream_tarsum,
+                          io.getvalue()[:2048], '', 512)
@@ -0,0 +1,29 @@
+import os
+import tempfile
+import unittest
+
+import config
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = config._config, os.environ['DOCKER_REGISTRY_CONFIG']
+        config._config = None
+
+    def tearDown(self):
+        config._config, os.environ['DOCKER_REGISTRY_CONFIG'] = self._saved
+
+    def load(self, data):
+        with tempfile.NamedTemporaryFile(suffix='.yml') as f:
+            f.write(data)
+            f.flush()
+            os.environ['DOCKER_REGISTRY_CONFIG'] = f.name
+            return config.load()
+
+    def test_layer_dedup(self):
+        cfg = self.load('test:\n  storage: s3\n  layer_dedup: true\n')
+        self.assertTrue(cfg.layer_dedup)
+        config._config = None
+        self.assertRaises(ValueError, self.load,
+                          'test:\n  storage: glance\n  layer_dedup: true\n')
@@ -0,0 +1,52 @@
+import random
+import unittest
+
+import files_index
+
+
+class TestFilesIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = sorted(set(
+            '/usr/{0}/{1}'.format(random.choice(['bin', 'lib', 'share']),
+                                  random.randint(0, 100000))
+            for i in range(1000)))
+        random.shuffle(self.paths)
+        self.index = files_index.FilesIndex(files_index.build(self.paths))
+        self.paths.sort()
+
+    def test_list(self):
+        self.assertEqual(len(self.index), len(self.paths))
+        self.assertEqual(list(self.index), self.paths)
+        self.assertEqual(self.index.list(), self.paths)
+
+    def test_empty(self):
+        index = files_index.FilesIndex(files_index.build([]))
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.list(prefix='/usr'), [])
+
+    def test_prefix(self):
+        for prefix in ('/usr/bin/', '/usr/lib/1', '/usr/share/99', '/x', ''):
+            self.assertEqual(self.index.list(prefix=prefix),
+                             [p for p in self.paths if p.startswith(prefix)])
+
+    def test_marker(self):
+        for marker in random.sample(self.paths, 20) + ['/', '/usr/c', '~']:
+            self.assertEqual(self.index.list(marker=marker, limit=10),
+                             [p for p in self.paths if p > marker][:10])
+
+    def test_pages(self):
+        pages = []
+        marker = None
+        while True:
+            page = self.index.list('/usr/lib/', marker, 7)
+            if not page:
+                break
+            pages.extend(page)
+            marker = page[-1]
+        self.assertEqual(pages,
+                         [p for p in self.paths if p.startswith('/usr/lib/')])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, files_index.FilesIndex, '["/etc"]')
+        self.assertFalse(files_index.is_index('[]'))
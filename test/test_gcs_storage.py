@@ -0,0 +1,81 @@
+import itertools
+import StringIO
+import unittest
+
+import storage.gcs
+
+
+class Key(object):
+
+    """In-memory GCS object. Like on GCS, the generation given along with
+       the components of a compose or a delete must be the current one. The
+       upload of the `fail' objects raises.
+    """
+
+    generations = itertools.count(1)
+
+    def __init__(self, bucket, name, fail=()):
+        self.bucket = bucket
+        self.name = name
+        self.fail = fail
+        self.generation = None
+
+    def _check_generation(self, key):
+        if key.generation and key.generation != self.bucket[key.name][0]:
+            raise IOError('Precondition failed: {0}'.format(key.name))
+
+    def set_contents_from_string(self, content):
+        if self.name in self.fail:
+            raise IOError('Upload failed')
+        self.generation = next(self.generations)
+        self.bucket[self.name] = (self.generation, content)
+
+    def compose(self, keys):
+        for key in keys:
+            self._check_generation(key)
+        # The generation of the composed object is not set on the key
+        self.bucket[self.name] = (next(self.generations),
+                                  ''.join(self.bucket[k.name][1]
+                                          for k in keys))
+
+    def delete(self):
+        self._check_generation(self)
+        del self.bucket[self.name]
+
+
+class TestGSStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = {}
+        # No connection is made, the objects are kept in `bucket'
+        self._storage = object.__new__(storage.gcs.GSStorage)
+        self._storage._root_path = 'registry'
+        self._storage._part_size = 4
+        self._storage.buffer_size = 4
+        self._storage.max_compose = 3
+        self._storage.part_retries = 1
+        self._storage.makeKey = lambda path: Key(self.bucket, path)
+
+    def content(self):
+        return dict((name, content)
+                    for name, (generation, content) in self.bucket.items())
+
+    def test_stream_write(self):
+        # More than 2 * max_compose parts, composed several times
+        content = '0123456789abcdefghijklmnopqrstuvwxyz'
+        self._storage.stream_write('foo', StringIO.StringIO(content))
+        # The temporary objects are removed
+        self.assertEqual(self.content(), {'registry/foo': content})
+        self._storage.stream_write('foo', StringIO.StringIO('abc'))
+        self.assertEqual(self.content(), {'registry/foo': 'abc'})
+        self._storage.stream_write('foo', StringIO.StringIO(''))
+        self.assertEqual(self.content(), {'registry/foo': ''})
+
+    def test_stream_write_failure(self):
+        self._storage.stream_write('foo', StringIO.StringIO('previous'))
+        self._storage.makeKey = lambda path: Key(
+            self.bucket, path, fail=[path] if path.endswith('_part7') else [])
+        self.assertRaises(IOError, self._storage.stream_write, 'foo',
+                          StringIO.StringIO('0123456789abcdefghijklmnopqrst'))
+        # Neither the parts nor a truncated object are left behind
+        self.assertEqual(self.content(), {'registry/foo': 'previous'})
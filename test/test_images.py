@@ -1,7 +1,19 @@
 
 import json
+import StringIO
+import tarfile
+import time
+import urlparse
+
+import mock
+import werkzeug.wsgi
 
 import base
+import storage
+
+# noqa is issued to allow imports do their monkeypatching as side effect
+import utils.mock_boto_s3                     # noqa
+from utils.mock_s3_storage import S3Storage   # noqa
 
 
 class TestImages(base.TestCase):
@@ -46,6 +58,206 @@ class TestImages(base.TestCase):
         finally:
             registry.images.cfg._config.pop('nginx_x_accel_redirect')
 
+    def test_file_wrapper(self):
+        image_id = self.gen_random_string()
+        layer_data = self.gen_random_string(1024)
+        self.upload_image(image_id, parent_id=None, layer=layer_data)
+        url = '/v1/images/{0}/layer'.format(image_id)
+        files = []
+
+        def file_wrapper(fp, block_size):
+            # Stands for the server's, which would use sendfile
+            files.append(fp)
+            return werkzeug.wsgi.FileWrapper(fp, block_size)
+        resp = self.http_client.get(
+            url, environ_overrides={'wsgi.file_wrapper': file_wrapper})
+        self.assertEqual(resp.data, layer_data)
+        self.assertEqual(resp.headers['Content-Length'], str(len(layer_data)))
+        self.assertEqual(len(files), 1)
+        # Servers without one get the file read by a generator
+        with mock.patch.object(werkzeug.wsgi, 'FileWrapper',
+                               wraps=werkzeug.wsgi.FileWrapper) as fallback:
+            resp = self.http_client.get(url)
+        self.assertEqual(resp.data, layer_data)
+        self.assertEqual(resp.headers['Content-Length'], str(len(layer_data)))
+        self.assertTrue(fallback.called)
+
+    def test_storage_redirect(self):
+        import registry.images
+        store = storage.load('s3')
+        image_id = self.gen_random_string()
+        layer_path = store.image_layer_path(image_id)
+        store.put_content(layer_path, self.gen_random_string(1024))
+        registry.images.cfg._config['storage_redirect'] = True
+        registry.images.cfg._config['storage_redirect_expires'] = 120
+        try:
+            with mock.patch.object(registry.images, 'store', store):
+                with mock.patch.object(store, 'stream_read') as stream_read:
+                    resp = self.http_client.get(
+                        '/v1/images/{0}/layer'.format(image_id))
+            self.assertEqual(resp.status_code, 302, resp.data)
+            url = urlparse.urlparse(resp.headers['Location'])
+            self.assertTrue(url.path.endswith(
+                '/' + store._init_path(layer_path)), url.path)
+            expires = int(urlparse.parse_qs(url.query)['Expires'][0])
+            self.assertTrue(0 <= expires - time.time() <= 120)
+            # The layer itself is not sent by the registry
+            self.assertFalse(stream_read.called)
+        finally:
+            registry.images.cfg._config.pop('storage_redirect')
+            registry.images.cfg._config.pop('storage_redirect_expires')
+            store.remove(layer_path)
+
+    def test_layer_range(self):
+        image_id = self.gen_random_string()
+        layer_data = self.gen_random_string(1024)
+        self.upload_image(image_id, parent_id=None, layer=layer_data)
+        url = '/v1/images/{0}/layer'.format(image_id)
+
+        resp = self.http_client.get(url, headers={'Range': 'bytes=100-199'})
+        self.assertEqual(resp.status_code, 206, resp.data)
+        self.assertEqual(layer_data[100:200], resp.data)
+        self.assertEqual('bytes 100-199/1024', resp.headers['Content-Range'])
+        # Suffix range
+        resp = self.http_client.get(url, headers={'Range': 'bytes=-24'})
+        self.assertEqual(resp.status_code, 206, resp.data)
+        self.assertEqual(layer_data[1000:], resp.data)
+        # Outdated If-Range, the whole layer is sent
+        resp = self.http_client.get(url, headers={'Range': 'bytes=100-',
+                                                  'If-Range': 'foobar'})
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(layer_data, resp.data)
+        resp = self.http_client.get(url, headers={'Range': 'bytes=2048-'})
+        self.assertEqual(resp.status_code, 416, resp.data)
+
+    def test_metadata_record(self):
+        import registry.images
+        registry.images.cfg._config['metadata_record'] = True
+        registry.images.cfg._config['ancestry_pieces'] = True
+        store = registry.images.store
+        store.ancestry_piece_size = 1
+        try:
+            image_id = self.gen_random_string()
+            parent_id = self.gen_random_string()
+            layer_data = self.gen_random_string(1024)
+            self.upload_image(parent_id, parent_id=None, layer=layer_data)
+            self.upload_image(image_id, parent_id=parent_id, layer=layer_data)
+            metadata = store.get_image_metadata(image_id)
+            self.assertEqual(metadata['size'], len(layer_data))
+            # The next pieces of the ancestry are shared with the parent
+            self.assertEqual(metadata['ancestry'],
+                             {'ids': [image_id], 'next': parent_id})
+            url = '/v1/images/{0}/ancestry'.format(image_id)
+            resp = self.http_client.get(url)
+            self.assertEqual(json.loads(resp.data), [image_id, parent_id])
+            # Written once the push is complete only
+            image_id = self.gen_random_string()
+            url = '/v1/images/{0}/json'.format(image_id)
+            resp = self.http_client.put(url,
+                                        data=json.dumps({'id': image_id}))
+            self.assertEqual(resp.status_code, 200, resp.data)
+            self.assertFalse(store.exists(store.image_metadata_path(
+                image_id)))
+        finally:
+            registry.images.cfg._config.pop('metadata_record')
+            registry.images.cfg._config.pop('ancestry_pieces')
+            del store.ancestry_piece_size
+
+    def test_layer_dedup(self):
+        import registry.images
+        registry.images.cfg._config['layer_dedup'] = True
+        try:
+            image_id = self.gen_random_string()
+            parent_id = self.gen_random_string()
+            layer_data = self.gen_random_string(1024)
+            self.upload_image(parent_id, parent_id=None, layer=layer_data)
+            self.upload_image(image_id, parent_id=parent_id, layer=layer_data)
+            store = registry.images.store
+            # Both images share the same blob
+            path = store.get_image_layer_path(image_id)
+            self.assertEqual(path, store.get_image_layer_path(parent_id))
+            self.assertFalse(store.exists(store.image_layer_path(image_id)))
+            url = '/v1/images/{0}/layer'.format(image_id)
+            resp = self.http_client.get(url)
+            self.assertEqual(resp.data, layer_data)
+            digest = store.get_content(store.image_layer_link_path(image_id))
+            ref_path = store.blob_ref_path(digest, image_id)
+            self.assertTrue(store.exists(ref_path))
+            # Unlinking never removes the blob, another push may use it
+            store.unlink_image_layer(parent_id)
+            store.unlink_image_layer(image_id)
+            self.assertFalse(store.exists(ref_path))
+            self.assertTrue(store.exists(path))
+            self.assertEqual(store.get_image_layer_path(image_id),
+                             store.image_layer_path(image_id))
+        finally:
+            registry.images.cfg._config.pop('layer_dedup')
+
+    def test_layer_dedup_checksum_after(self):
+        import registry.images
+        store = registry.images.store
+        registry.images.cfg._config['layer_dedup'] = True
+
+        def set_checksum_callback(image_id, checksum):
+            # Not linked to a blob before the checksum is verified
+            self.assertFalse(store.exists(
+                store.image_layer_link_path(image_id)))
+            url = '/v1/images/{0}/checksum'.format(image_id)
+            resp = self.http_client.put(
+                url, headers={'X-Docker-Checksum': checksum})
+            self.assertEqual(resp.status_code, 200, resp.data)
+            self.assertTrue(store.exists(
+                store.image_layer_link_path(image_id)))
+        try:
+            image_id = self.gen_random_string()
+            self.upload_image(image_id, parent_id=None,
+                              layer=self.gen_random_string(1024),
+                              set_checksum_callback=set_checksum_callback)
+            # A layer not matching its checksum is not linked
+            image_id = self.gen_random_string()
+            url = '/v1/images/{0}/json'.format(image_id)
+            resp = self.http_client.put(
+                url, data=json.dumps({'id': image_id}),
+                headers={'X-Docker-Checksum': 'sha256:0'})
+            self.assertEqual(resp.status_code, 200, resp.data)
+            url = '/v1/images/{0}/layer'.format(image_id)
+            resp = self.http_client.put(url, data=self.gen_random_string())
+            self.assertEqual(resp.status_code, 400, resp.data)
+            self.assertFalse(store.exists(
+                store.image_layer_link_path(image_id)))
+        finally:
+            registry.images.cfg._config.pop('layer_dedup')
+
+    def test_files(self):
+        layer_file = StringIO.StringIO()
+        tar = tarfile.open(mode='w', fileobj=layer_file)
+        for name in ('./etc/hosts', './usr/bin/true'):
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            tar.addfile(info, StringIO.StringIO('data'))
+        tar.close()
+        image_id = self.gen_random_string()
+        self.upload_image(image_id, parent_id=None,
+                          layer=layer_file.getvalue())
+        import registry.images
+        store = registry.images.store
+        # The files list is built during the push
+        self.assertTrue(store.exists(store.image_files_path(image_id)))
+        url = '/v1/images/{0}/files'.format(image_id)
+        resp = self.http_client.get(url)
+        self.assertEqual(json.loads(resp.data),
+                         ['/etc/hosts', '/usr/bin/true'])
+        resp = self.http_client.get(url + '?prefix=/usr/')
+        self.assertEqual(json.loads(resp.data), ['/usr/bin/true'])
+        resp = self.http_client.get(url + '?limit=1')
+        self.assertEqual(json.loads(resp.data), ['/etc/hosts'])
+        self.assertTrue('rel="next"' in resp.headers['Link'])
+        resp = self.http_client.get(url + '?limit=1&marker=/etc/hosts')
+        self.assertEqual(json.loads(resp.data), ['/usr/bin/true'])
+        self.assertFalse('Link' in resp.headers)
+        resp = self.http_client.get(url + '?limit=0')
+        self.assertEqual(resp.status_code, 400, resp.data)
+
     def test_simple(self):
         image_id = self.gen_random_string()
         parent_id = self.gen_random_string()
@@ -59,6 +271,56 @@ class TestImages(base.TestCase):
         self.assertEqual(ancestry[0], image_id)
         self.assertEqual(ancestry[1], parent_id)
 
+    def test_deep_ancestry(self):
+        import registry.images
+        store = registry.images.store
+        store.ancestry_piece_size = 2
+        registry.images.cfg._config['ancestry_pieces'] = True
+        try:
+            ancestry = []
+            parent_id = None
+            for i in range(5):
+                image_id = self.gen_random_string()
+                self.upload_image(image_id, parent_id=parent_id,
+                                  layer=self.gen_random_string(16))
+                ancestry.insert(0, image_id)
+                parent_id = image_id
+            # Each image only stores a piece of its ancestry
+            piece = json.loads(store.get_content(
+                store.image_ancestry_path(image_id)))
+            self.assertTrue(len(piece['ids']) <= 2)
+            resp = self.http_client.get(
+                '/v1/images/{0}/ancestry'.format(image_id))
+            self.assertEqual(json.loads(resp.data), ancestry)
+            # Whole lists, readable by the registries not upgraded yet
+            registry.images.cfg._config.pop('ancestry_pieces')
+            image_id = self.gen_random_string()
+            self.upload_image(image_id, parent_id=parent_id,
+                              layer=self.gen_random_string(16))
+            self.assertEqual(json.loads(store.get_content(
+                store.image_ancestry_path(image_id))), [image_id] + ancestry)
+        finally:
+            registry.images.cfg._config.pop('ancestry_pieces', None)
+            del store.ancestry_piece_size
+
+    def test_bulk_json(self):
+        image_id = self.gen_random_string()
+        parent_id = self.gen_random_string()
+        layer_data = self.gen_random_string(1024)
+        self.upload_image(parent_id, parent_id=None, layer=layer_data)
+        self.upload_image(image_id, parent_id=parent_id, layer=layer_data)
+        unknown_id = self.gen_random_string()
+        resp = self.http_client.get('/v1/images/json?ids={0}'.format(
+            ','.join([image_id, parent_id, unknown_id])))
+        self.assertEqual(resp.status_code, 200, resp.data)
+        data = json.loads(resp.data)
+        self.assertEqual(sorted(data.keys()), sorted([image_id, parent_id]))
+        self.assertEqual(data[image_id]['json']['parent'], parent_id)
+        self.assertEqual(data[image_id]['size'], len(layer_data))
+        self.assertTrue(data[image_id]['checksum'].startswith('sha256:'))
+        resp = self.http_client.get('/v1/images/json')
+        self.assertEqual(resp.status_code, 400, resp.data)
+
     def test_notfound(self):
         resp = self.http_client.get('/v1/images/{0}/json'.format(
             self.gen_random_string()))
@@ -1,7 +1,11 @@
 
 import cStringIO as StringIO
+import os
+import shutil
+import tempfile
 
 import base
+import config
 import storage
 
 
@@ -46,9 +50,134 @@ class TestLocalStorage(base.TestCase):
         self._storage.remove(filename)
         self.assertFalse(self._storage.exists(filename))
 
+    def test_stream_range(self):
+        filename = self.gen_random_string()
+        content = self.gen_random_string(1024)
+        self._storage.put_content(filename, content)
+        data = ''
+        for buf in self._storage.stream_read(filename, (10, 99)):
+            data += buf
+        self.assertEqual(content[10:100], data)
+        self._storage.remove(filename)
+
     def test_errors(self):
         notexist = self.gen_random_string()
         self.assertRaises(IOError, self._storage.get_content, notexist)
         iterator = self._storage.list_directory(notexist)
         self.assertRaises(OSError, next, iterator)
         self.assertRaises(OSError, self._storage.get_size, notexist)
+
+    def test_list_page(self):
+        path = self.gen_random_string()
+        for name in ('a1', 'a2', 'b1', 'c1'):
+            self._storage.put_content('{0}/{1}'.format(path, name), name)
+        names = sorted(self._storage.list_directory(path))
+        page, marker = self._storage.list_page(path, limit=3)
+        self.assertEqual(page, names[:3])
+        page, marker = self._storage.list_page(path, marker=marker, limit=3)
+        self.assertEqual(page, names[3:])
+        self.assertIsNone(marker)
+        page, marker = self._storage.list_page(path, prefix='a')
+        self.assertEqual(page, names[:2])
+        self.assertEqual(
+            self._storage.list_directory_parallel(path, prefixes='abc'),
+            names)
+        # Found in the gaps around and between the prefixes as well
+        for name in ('-1', 'b2', 'z1'):
+            self._storage.put_content('{0}/{1}'.format(path, name), name)
+        names = sorted(self._storage.list_directory(path))
+        self.assertEqual(len(names), 7)
+        self.assertEqual(
+            self._storage.list_directory_parallel(path, prefixes='ac'),
+            names)
+        self.assertEqual(self._storage.list_page(self.gen_random_string()),
+                         ([], None))
+        for name in ('a1', 'a2', 'b1', 'c1', '-1', 'b2', 'z1'):
+            self._storage.remove('{0}/{1}'.format(path, name))
+
+    def test_multi(self):
+        paths = [self.gen_random_string() for i in range(3)]
+        for path in paths[:2]:
+            self._storage.put_content(path, path)
+        self.assertEqual(self._storage.multi_get(paths),
+                         dict((path, path) for path in paths[:2]))
+        self.assertEqual(self._storage.multi_exists(paths),
+                         {paths[0]: True, paths[1]: True, paths[2]: False})
+        self.assertEqual(self._storage.multi_size(paths),
+                         dict((path, len(path)) for path in paths[:2]))
+        for path in paths[:2]:
+            self._storage.remove(path)
+
+
+class TestLocalStorageSharding(base.TestCase):
+
+    def setUp(self):
+        self._cfg = config.Config({'storage_path': tempfile.mkdtemp(),
+                                   'storage_sharding': True})
+        self._storage = storage.LocalStorage(self._cfg)
+
+    def tearDown(self):
+        shutil.rmtree(self._cfg.storage_path)
+
+    def test_sharding(self):
+        cfg, store = self._cfg, self._storage
+        flat_id = self.gen_random_string(64)
+        sharded_id = self.gen_random_string(64)
+        # An image stored before the sharding was enabled
+        flat_path = os.path.join(cfg.storage_path, store.images, flat_id)
+        os.makedirs(flat_path)
+        with open(os.path.join(flat_path, 'json'), 'w') as f:
+            f.write('flat')
+        store.put_content(store.image_json_path(sharded_id), 'sharded')
+        sharded_path = '/'.join([store.images, sharded_id[:2],
+                                 sharded_id[2:4], sharded_id, 'json'])
+        self.assertTrue(os.path.exists(os.path.join(cfg.storage_path,
+                                                    sharded_path)))
+        # Served by nginx from there
+        self.assertEqual(store.stored_path(store.image_json_path(sharded_id)),
+                         sharded_path)
+        self.assertEqual(store.stored_path(store.image_json_path(flat_id)),
+                         store.image_json_path(flat_id))
+        self.assertEqual(store.get_content(store.image_json_path(flat_id)),
+                         'flat')
+        self.assertEqual(
+            sorted(store.list_directory(store.images)),
+            sorted(['{0}/{1}'.format(store.images, i)
+                    for i in (flat_id, sharded_id)]))
+        self.assertEqual(list(store.unsharded_images()), [flat_id])
+        # Written to the shard while the image is being migrated
+        store.put_content(store.image_layer_path(flat_id), 'layer')
+        store.shard_image(flat_id)
+        self.assertFalse(os.path.exists(flat_path))
+        self.assertEqual(list(store.unsharded_images()), [])
+        self.assertEqual(store.get_content(store.image_json_path(flat_id)),
+                         'flat')
+        self.assertEqual(store.get_content(store.image_layer_path(flat_id)),
+                         'layer')
+        store.remove('{0}/{1}'.format(store.images, flat_id))
+        self.assertFalse(store.exists(store.image_json_path(flat_id)))
+
+    def test_read_while_sharding(self):
+        store = self._storage
+        image_id = self.gen_random_string(64)
+        flat_path = os.path.join(self._cfg.storage_path, store.images,
+                                 image_id)
+        os.makedirs(flat_path)
+        with open(os.path.join(flat_path, 'json'), 'w') as f:
+            f.write('flat')
+        path = store.image_json_path(image_id)
+        # Sharded between the miss at the sharded path and the flat one
+        tried = []
+
+        def open_sharding(p):
+            tried.append(p)
+            if p.startswith(flat_path):
+                store.shard_image(image_id)
+            return open(p)
+
+        with store._lookup(path, open_sharding) as f:
+            self.assertEqual(f.read(), 'flat')
+        self.assertEqual(len(tried), 3)
+        self.assertFalse(os.path.exists(flat_path))
+        self.assertTrue(store.exists(path))
+        self.assertEqual(store.get_size(path), 4)
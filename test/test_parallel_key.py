@@ -0,0 +1,72 @@
+import random
+import unittest
+
+import gevent
+
+import storage.boto_base
+
+
+class Key(object):
+
+    """Boto key serving `content', the ranges are fetched after a random
+       delay so that they complete out of order.
+    """
+
+    def __init__(self, content, fail_at=None):
+        self.content = content
+        self.size = len(content)
+        self.fail_at = fail_at
+        self.ranges = []
+
+    def open_read(self, headers=None):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        self._pos, self._end = int(start), int(end) + 1
+        self.ranges.append((self._pos, self._end))
+        gevent.sleep(random.random() * 0.01)
+
+    def read(self, size):
+        if self.fail_at is not None and self._pos <= self.fail_at < self._end:
+            raise IOError('Connection reset')
+        buf = self.content[self._pos:min(self._pos + size, self._end)]
+        self._pos += len(buf)
+        return buf
+
+    def close(self):
+        pass
+
+
+class TestParallelKey(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (storage.boto_base.ParallelKey.min_part_size,
+                       storage.boto_base.ParallelKey.chunk_size)
+        storage.boto_base.ParallelKey.min_part_size = 1024
+        storage.boto_base.ParallelKey.chunk_size = 100
+        self.content = ''.join(chr(random.randint(0, 255))
+                               for i in range(20 * 1024 + 7))
+
+    def tearDown(self):
+        (storage.boto_base.ParallelKey.min_part_size,
+         storage.boto_base.ParallelKey.chunk_size) = self._saved
+
+    def read_all(self, pkey):
+        data = []
+        while True:
+            buf = pkey.read(333)
+            if not buf:
+                return ''.join(data)
+            data.append(buf)
+
+    def test_order(self):
+        key = Key(self.content)
+        pkey = storage.boto_base.ParallelKey(key)
+        self.assertEqual(self.read_all(pkey), self.content)
+        # Every byte is fetched once
+        self.assertEqual(sorted(key.ranges),
+                         [(i, min(i + 1280, key.size))
+                          for i in range(0, key.size, 1280)])
+
+    def test_error(self):
+        key = Key(self.content, fail_at=10 * 1024)
+        pkey = storage.boto_base.ParallelKey(key)
+        self.assertRaises(IOError, self.read_all, pkey)
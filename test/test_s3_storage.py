@@ -1,11 +1,18 @@
 
-import storage
+import random
 import StringIO
 import sys
+
+import gevent
+import mock
+
+import cache
+import storage
 import test_local_storage
 
 # noqa is issued to allow imports do their monkeypatching as side effect
 import utils.mock_boto_s3                     # noqa
+import utils.mock_redis
 from utils.mock_s3_storage import S3Storage   # noqa
 
 StringIO_read = StringIO.StringIO.read
@@ -63,6 +70,99 @@ class TestS3Storage(test_local_storage.TestLocalStorage):
         self._storage.buffer_size = 5 * 1024 * 1024
         self.assertFalse(self._storage.exists(filename))
 
+    def test_stream_write_cache(self):
+        saved = cache.redis_conn, cache.cache_prefix, cache.exists_prefix
+        cache.redis_conn = utils.mock_redis.StrictRedis()
+        cache.cache_prefix = 'cache_path:'
+        cache.exists_prefix = 'cache_exists:'
+        try:
+            # The decorators are only applied when the cache is enabled
+            stream_write = cache.put_stream(S3Storage.stream_write.im_func)
+            filename = self.gen_random_string()
+            cache.redis_conn.set(cache.cache_key(filename), 'old')
+            cache.redis_conn.set(cache.exists_key(filename), 'False')
+            content = self.gen_random_string(6 * 1024 * 1024)
+            stream_write(self._storage, filename, StringIO.StringIO(content))
+            self.assertIsNone(cache.redis_conn.get(cache.cache_key(filename)))
+            self.assertIsNone(cache.redis_conn.get(
+                cache.exists_key(filename)))
+            self.assertEqual(self._storage.get_content(filename), content)
+        finally:
+            cache.redis_conn, cache.cache_prefix, cache.exists_prefix = saved
+
+    def stream_write_parts(self, fail):
+        """Writes 6 parts, which are uploaded in a random order. `fail'
+           tells how many times the upload of each part fails.
+        """
+        mp_class = utils.mock_boto_s3.MultiPartUpload
+        upload_part = mp_class.upload_part_from_file
+        sleep = gevent.sleep
+        fail = dict(fail)
+
+        def upload(mp, io, num_part):
+            sleep(random.random() * 0.01)
+            if fail.get(num_part):
+                fail[num_part] -= 1
+                raise IOError('Connection reset')
+            upload_part(mp, io, num_part)
+        part_size = 128 * 1024
+        self._storage._part_size = part_size
+        buffer_size = self._storage.buffer_size
+        self._storage.buffer_size = part_size
+        self.filename = self.gen_random_string()
+        self.content = ''.join(chr(ord('a') + i) * part_size
+                               for i in range(6))
+        try:
+            with mock.patch.object(mp_class, 'upload_part_from_file',
+                                   upload):
+                with mock.patch.object(mp_class, 'cancel_upload') as cancel:
+                    with mock.patch('gevent.sleep') as backoff:
+                        try:
+                            self._storage.stream_write(
+                                self.filename, StringIO.StringIO(self.content))
+                        finally:
+                            self.cancel = cancel
+                            self.backoff = backoff
+        finally:
+            self._storage._part_size = 5 * 1024 * 1024
+            self._storage.buffer_size = buffer_size
+
+    def test_stream_write_order(self):
+        self.stream_write_parts({})
+        self.assertEqual(self._storage.get_content(self.filename),
+                         self.content)
+
+    def test_stream_write_retry(self):
+        self.stream_write_parts({2: 1, 5: 2})
+        self.assertEqual(self._storage.get_content(self.filename),
+                         self.content)
+        self.assertEqual(self.backoff.call_count, 3)
+        self.assertFalse(self.cancel.called)
+
+    def test_stream_write_failure(self):
+        retries = self._storage.part_retries
+        self.assertRaises(IOError, self.stream_write_parts, {3: retries})
+        self.assertTrue(self.cancel.called)
+        self.assertFalse(self._storage.exists(self.filename))
+        # No backoff once the attempts are used up
+        self.assertEqual(self.backoff.call_count, retries - 1)
+
+    def test_move_encrypted(self):
+        filename = self.gen_random_string()
+        self._storage.put_content(filename, 'abc')
+        bucket = self._storage._boto_bucket
+        self._storage._config._config['s3_encrypt'] = True
+        try:
+            with mock.patch.object(bucket, 'copy_key',
+                                   wraps=bucket.copy_key) as copy_key:
+                self._storage.move(filename, filename + '.moved')
+        finally:
+            self._storage._config._config.pop('s3_encrypt')
+        self.assertTrue(copy_key.call_args[1]['encrypt_key'])
+        self.assertEqual(self._storage.get_content(filename + '.moved'),
+                         'abc')
+        self.assertFalse(self._storage.exists(filename))
+
     def test_init_path(self):
         # s3 storage _init_path result keys are relative (no / at start)
         root_path = self._storage._root_path
@@ -0,0 +1,88 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import base
+
+import registry.toolkit
+
+
+class TestSignedToken(base.TestCase):
+
+    key = 'foobar42'
+
+    def setUp(self):
+        cfg = registry.toolkit.config.load()
+        self._saved = dict((k, cfg._config.get(k))
+                           for k in ('standalone', 'signed_token_key'))
+        cfg._config['standalone'] = False
+        cfg._config['signed_token_key'] = self.key
+
+    def tearDown(self):
+        cfg = registry.toolkit.config.load()
+        for k, v in self._saved.iteritems():
+            if v is None:
+                cfg._config.pop(k, None)
+            else:
+                cfg._config[k] = v
+
+    def gen_token(self, key=None, **claims):
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+        claims.setdefault('exp', int(time.time()) + 60)
+        data = '{0}.{1}'.format(encode({'alg': 'HS256', 'typ': 'JWT'}),
+                                encode(claims))
+        signature = hmac.new(key or self.key, data, hashlib.sha256).digest()
+        return '{0}.{1}'.format(
+            data, base64.urlsafe_b64encode(signature).rstrip('='))
+
+    def get_image(self, token):
+        url = '/v1/images/{0}/json'.format(self.gen_random_string())
+        headers = {'Authorization': 'Bearer {0}'.format(token)}
+        return self.http_client.get(url, headers=headers)
+
+    def test_verify(self):
+        token = self.gen_token(access='read', repository='foo/bar')
+        claims = registry.toolkit.verify_signed_token(token, self.key)
+        self.assertEqual(claims['repository'], 'foo/bar')
+        self.assertEqual(
+            registry.toolkit.verify_signed_token(token, 'other'), None)
+        expired = self.gen_token(exp=int(time.time()) - 1)
+        self.assertEqual(
+            registry.toolkit.verify_signed_token(expired, self.key), None)
+        self.assertEqual(
+            registry.toolkit.verify_signed_token('a.b.c', self.key), None)
+
+    def test_requires_auth(self):
+        # Authorized, the image does not exist though
+        token = self.gen_token(access='read', repository='foo/bar')
+        resp = self.get_image(token)
+        self.assertEqual(resp.status_code, 404, resp.data)
+        # Served from the memoized claims the second time
+        resp = self.get_image(token)
+        self.assertEqual(resp.status_code, 404, resp.data)
+        resp = self.get_image(self.gen_token(access='write',
+                                             repository='foo/bar'))
+        self.assertEqual(resp.status_code, 401, resp.data)
+        resp = self.get_image(self.gen_token(key='wrong', access='read',
+                                             repository='foo/bar'))
+        self.assertEqual(resp.status_code, 401, resp.data)
+
+    def test_required_claims(self):
+        for claims in ({'repository': 'foo/bar'},
+                       {'repository': 'foo/bar', 'access': 'none'},
+                       {'access': 'read'},
+                       {'access': 'read', 'repository': 'bar'}):
+            resp = self.get_image(self.gen_token(**claims))
+            self.assertEqual(resp.status_code, 401, claims)
+
+    def test_repository(self):
+        name = 'foo/{0}'.format(self.gen_random_string().lower())
+        url = '/v1/repositories/{0}/tags'.format(name)
+        for repository, code in ((name, 404), ('foo/other', 401)):
+            token = self.gen_token(access='read', repository=repository)
+            headers = {'Authorization': 'Bearer {0}'.format(token)}
+            resp = self.http_client.get(url, headers=headers)
+            self.assertEqual(resp.status_code, code, resp.data)
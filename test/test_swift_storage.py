@@ -1,6 +1,8 @@
 
 import StringIO
 
+import mock
+
 # noqa is issued to allow imports do their monkeypatching as side effect
 from utils.mock_swift_storage import Connection   # noqa
 
@@ -12,6 +14,9 @@ class TestSwiftStorage(test_local_storage.TestLocalStorage):
 
     def setUp(self):
         self._storage = storage.load('swift')
+        # The segments are copied from "/<container>/<path>"
+        self._storage._swift_container = (self._storage._swift_container or
+                                          'registry-test')
         self._storage._swift_connection.put_container(
             self._storage._swift_container
         )
@@ -61,3 +66,38 @@ class TestSwiftStorage(test_local_storage.TestLocalStorage):
             self._storage._root_path = root_path[1:]
             self.assertFalse(self._storage._init_path().startswith('/'))
             self._storage._root_path = root_path
+
+    def test_stream_write_segments(self):
+        self._storage._segment_size = 3 * 1024 * 1024
+        filename = self.gen_random_string()
+        content = self.gen_random_string(8 * 1024 * 1024)
+        self._storage.stream_write(filename, StringIO.StringIO(content))
+        self.assertEqual(self._storage.get_size(filename), len(content))
+        self.assertEqual(''.join(self._storage.stream_read(filename)),
+                         content)
+        # Removing the manifest removes the segments as well
+        self._storage.remove(filename)
+        self.assertFalse(self._storage.exists(filename))
+        self.assertEqual(
+            self._storage._swift_connection._swift_containers[
+                self._storage._swift_container], {})
+        self._storage._segment_size = 1024 * 1024 * 1024
+
+    def test_list_directory_parallel(self):
+        path = self.gen_random_string()
+        # Image directories, listed as their prefix
+        ids = sorted(['0a', '0b', '9a', 'fa', 'zz'])
+        for image_id in ids:
+            self._storage.put_content('{0}/{1}/json'.format(path, image_id),
+                                      image_id)
+        page, marker = self._storage.list_page(path, limit=2)
+        self.assertEqual(page, ids[:2])
+        page, marker = self._storage.list_page(path, marker=marker)
+        self.assertEqual(page, ids[2:])
+        # A page per prefix and per gap, never the whole directory
+        with mock.patch.object(self._storage, 'list_directory',
+                               side_effect=AssertionError):
+            self.assertEqual(self._storage.list_directory_parallel(path),
+                             ids)
+        for image_id in ids:
+            self._storage.remove('{0}/{1}/json'.format(path, image_id))
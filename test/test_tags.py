@@ -1,6 +1,8 @@
 
 import json
 
+import mock
+
 import base
 
 
@@ -44,6 +46,73 @@ class TestTags(base.TestCase):
         resp = self.http_client.get(url)
         self.assertEqual(resp.status_code, 404, resp.data)
 
+    def test_without_manifest(self):
+        import registry.tags
+        store = registry.tags.store
+        repos_name = self.gen_random_string()
+        image_id = self.gen_random_string()
+        self.upload_image(image_id, parent_id=None,
+                          layer=self.gen_random_string(1024))
+        for tag in ('latest', 'test'):
+            url = '/v1/repositories/foo/{0}/tags/{1}'.format(repos_name, tag)
+            resp = self.http_client.put(url, data=json.dumps(image_id))
+            self.assertEqual(resp.status_code, 200, resp.data)
+        # Tags pushed before the manifest existed are still listed
+        manifest_path = store.tags_manifest_path('foo', repos_name)
+        store.remove(manifest_path)
+        url = '/v1/repositories/foo/{0}/tags'.format(repos_name)
+        resp = self.http_client.get(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(json.loads(resp.data),
+                         {'latest': image_id, 'test': image_id})
+        # Listings never write it
+        self.assertFalse(store.exists(manifest_path))
+
+    def test_manifest_update(self):
+        import registry.tags
+        store = registry.tags.store
+        repos_name = self.gen_random_string()
+        image_id = self.gen_random_string()
+        self.upload_image(image_id, parent_id=None,
+                          layer=self.gen_random_string(1024))
+        url = '/v1/repositories/foo/{0}/tags/latest'.format(repos_name)
+        resp = self.http_client.put(url, data=json.dumps(image_id))
+        self.assertEqual(resp.status_code, 200, resp.data)
+        # Tagged before the manifest existed
+        manifest_path = store.tags_manifest_path('foo', repos_name)
+        store.remove(manifest_path)
+        store.put_content(store.tag_path('foo', repos_name, 'old'), image_id)
+        url = '/v1/repositories/foo/{0}/tags/test'.format(repos_name)
+        resp = self.http_client.put(url, data=json.dumps(image_id))
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(json.loads(store.get_content(manifest_path)),
+                         {'latest': image_id, 'test': image_id,
+                          'old': image_id})
+        # A concurrent push replaces the manifest right after it is written
+        put_content = store.put_content
+
+        def concurrent_put(path, content):
+            put_content(path, content)
+            if path == manifest_path and not concurrent_put.done:
+                concurrent_put.done = True
+                put_content(path, json.dumps({'latest': image_id,
+                                              'other': image_id}))
+        concurrent_put.done = False
+        url = '/v1/repositories/foo/{0}/tags/new'.format(repos_name)
+        with mock.patch.object(store, 'put_content', concurrent_put):
+            resp = self.http_client.put(url, data=json.dumps(image_id))
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(json.loads(store.get_content(manifest_path)),
+                         {'latest': image_id, 'other': image_id,
+                          'new': image_id})
+        url = '/v1/repositories/foo/{0}/tags/latest'.format(repos_name)
+        resp = self.http_client.delete(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        url = '/v1/repositories/foo/{0}/tags'.format(repos_name)
+        resp = self.http_client.get(url)
+        self.assertEqual(json.loads(resp.data),
+                         {'other': image_id, 'new': image_id})
+
     def test_notfound(self):
         notexist = self.gen_random_string()
         url = '/v1/repositories/{0}/bar/tags'.format(notexist)
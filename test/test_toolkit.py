@@ -0,0 +1,115 @@
+import cookielib
+import httplib
+import StringIO
+import urllib2
+
+import mock
+
+import base
+
+import registry.toolkit
+import utils.mock_redis
+
+cache = registry.toolkit.cache
+
+
+class TestTokenCache(base.TestCase):
+
+    def setUp(self):
+        self._saved = (cache.token_ttl, cache.token_cache, cache.token_prefix,
+                       cache.digest_prefix, cache.redis_conn)
+        cache.token_ttl = 60
+        cache.token_cache = cache.LRUCache(100, 100)
+        cache.token_prefix = 'cache_token:'
+        cache.digest_prefix = 'cache_digest:'
+        cache.redis_conn = utils.mock_redis.StrictRedis()
+        self.auth = {'signature': 'abc', 'repository': 'foo/bar',
+                     'access': 'read'}
+        self.headers = {'Authorization': 'Token signature=abc,'
+                        'repository="foo/bar",access=read'}
+
+    def tearDown(self):
+        (cache.token_ttl, cache.token_cache, cache.token_prefix,
+         cache.digest_prefix, cache.redis_conn) = self._saved
+
+    def validate(self, status_code):
+        resp = mock.Mock(status_code=status_code, text='[]')
+        with mock.patch.object(registry.toolkit, 'index_request',
+                               return_value=resp) as index_request:
+            with registry.app.test_request_context(headers=self.headers):
+                valid = registry.toolkit.validate_token(self.auth)
+        return valid, index_request.call_count
+
+    def test_valid(self):
+        self.assertEqual(self.validate(200), (True, 1))
+        self.assertEqual(self.validate(200), (True, 0))
+        # Known by the other workers through Redis
+        cache.token_cache = cache.LRUCache(100, 100)
+        self.assertEqual(self.validate(200), (True, 0))
+
+    def test_rejected(self):
+        self.assertEqual(self.validate(401), (False, 1))
+        self.assertEqual(self.validate(200), (False, 0))
+
+    def test_not_cached(self):
+        # Index errors are not remembered
+        self.assertEqual(self.validate(502), (False, 1))
+        self.assertEqual(self.validate(200), (True, 1))
+
+    def test_disabled(self):
+        cache.token_cache = None
+        self.assertEqual(self.validate(200), (True, 1))
+        self.assertEqual(self.validate(200), (True, 1))
+
+
+class TestIndexSession(base.TestCase):
+
+    def test_no_cookies(self):
+        jar = registry.toolkit.index_session().cookies
+        resp = mock.Mock()
+        resp.info.return_value = httplib.HTTPMessage(StringIO.StringIO(
+            'Set-Cookie: session=user1; Path=/\r\n\r\n'))
+        jar.extract_cookies(resp, urllib2.Request('https://index.docker.io/'))
+        # Would be sent along with the requests made for the other users
+        self.assertEqual(len(jar), 0)
+        # Kept by a default jar
+        jar = cookielib.CookieJar()
+        jar.extract_cookies(resp, urllib2.Request('https://index.docker.io/'))
+        self.assertEqual(len(jar), 1)
+
+
+class TestImagesList(base.TestCase):
+
+    def setUp(self):
+        self.store = registry.toolkit.storage.load()
+        self.namespace = 'foo'
+        self.repository = self.gen_random_string()
+        self.path = self.store.images_list_path(self.namespace,
+                                                self.repository)
+
+    def update(self, images_list):
+        with mock.patch.object(self.store, 'put_content',
+                               wraps=self.store.put_content) as put_content:
+            registry.toolkit.update_images_list(self.namespace,
+                                                self.repository, images_list)
+        return put_content.call_count
+
+    def test_unchanged(self):
+        self.assertEqual(self.update(['a', 'b']), 1)
+        self.assertEqual(self.update(['a', 'b']), 0)
+        self.assertEqual(self.update(['a', 'b', 'c']), 1)
+        self.assertEqual(self.store.get_content(self.path), '["a", "b", "c"]')
+
+    def test_deleted_repository(self):
+        self.assertEqual(self.update(['a']), 1)
+        self.store.put_content(
+            self.store.tag_path(self.namespace, self.repository, 'latest'),
+            'a')
+        url = '/v1/repositories/{0}/{1}/tags'.format(self.namespace,
+                                                     self.repository)
+        resp = self.http_client.delete(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertFalse(self.store.exists(self.path))
+        # Written again on the next push
+        self.assertEqual(self.update(['a']), 1)
+        self.assertTrue(self.store.exists(self.path))
@@ -1,9 +1,14 @@
 
 '''Monkeypatch s3 boto library for unittesting.'''
 
+import time
+
+import boto.provider
+import boto.resultset
 import boto.s3.bucket
 import boto.s3.connection
 import boto.s3.key
+import boto.s3.prefix
 import mock_dict
 import utils
 
@@ -14,20 +19,31 @@ class MultiPartUpload(boto.s3.multipart.MultiPartUpload):
     __metaclass__ = utils.monkeypatch_class
 
     def upload_part_from_file(self, io, num_part):
-        if num_part == 1:
-            self.bucket._bucket[self.bucket.name][self._tmp_key] = io.read()
-        else:
-            self.bucket._bucket[self.bucket.name][self._tmp_key] += io.read()
+        # boto sets it to None
+        if getattr(self, '_parts', None) is None:
+            self._parts = {}
+        self._parts[num_part] = io.read()
 
     def complete_upload(self):
-        return None
+        parts = getattr(self, '_parts', None) or {}
+        self.bucket._bucket[self.bucket.name][self._tmp_key] = ''.join(
+            parts[i] for i in sorted(parts))
+
+    def cancel_upload(self):
+        self._parts = {}
 
 
 class S3Connection(boto.s3.connection.S3Connection):
     __metaclass__ = utils.monkeypatch_class
 
     def __init__(self, *args, **kwargs):
-        return None
+        self.provider = boto.provider.Provider('aws', 'access', 'secret')
+
+    def generate_url(self, expires_in, method, bucket='', key='',
+                     *args, **kwargs):
+        # Not signed
+        return 'https://{0}.s3.amazonaws.com/{1}?Expires={2}'.format(
+            bucket, key, int(time.time() + expires_in))
 
     def get_bucket(self, name, **kwargs):
         # Create a bucket for testing
@@ -63,6 +79,27 @@ class Bucket(boto.s3.bucket.Bucket):
         return ([self.lookup(k) for k in self._bucket_dict.keys()]
                 if self._bucket_dict else [])
 
+    def get_all_keys(self, headers=None, prefix='', delimiter=None,
+                     marker='', max_keys=1000):
+        names = []
+        for key_name in sorted(self._bucket_dict or []):
+            if not key_name.startswith(prefix):
+                continue
+            if delimiter and delimiter in key_name[len(prefix):]:
+                # Common prefix
+                rest = key_name[len(prefix):]
+                key_name = prefix + rest[:rest.index(delimiter) + 1]
+            if key_name > marker and key_name not in names:
+                names.append(key_name)
+        keys = boto.resultset.ResultSet()
+        for key_name in names[:max_keys]:
+            if delimiter and key_name.endswith(delimiter):
+                keys.append(boto.s3.prefix.Prefix(self, key_name))
+            else:
+                keys.append(self.lookup(key_name))
+        keys.is_truncated = len(names) > max_keys
+        return keys
+
     def lookup(self, key_name, **kwargs):
         if self._bucket_dict and key_name in self._bucket_dict:
             value = Bucket._bucket[self.name][key_name]
@@ -71,6 +108,11 @@ class Bucket(boto.s3.bucket.Bucket):
             k.size = len(value)
             return k
 
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name,
+                 **kwargs):
+        value = Bucket._bucket[src_bucket_name][src_key_name]
+        self._bucket_dict[new_key_name] = value
+
     def initiate_multipart_upload(self, key_name, **kwargs):
         # Pass key_name to MultiPartUpload
         mp = MultiPartUpload(self)
@@ -106,4 +148,8 @@ class Key(boto.s3.key.Key):
         # fetch read status
         lp = getattr(self, '_last_position', 0)
         self._last_position = lp + buffer_size
-        return self.bucket._bucket_dict[self.name][lp:lp + buffer_size]
+        end = lp + buffer_size
+        if hasattr(self, '_last_byte'):
+            # Range read
+            end = min(end, self._last_byte)
+        return self.bucket._bucket_dict[self.name][lp:end]
@@ -0,0 +1,66 @@
+'''In-memory Redis, with the commands used by lib/cache'''
+
+import time
+
+
+class StrictRedis(object):
+
+    def __init__(self, *args, **kwargs):
+        self._data = {}
+        self._expires = {}
+
+    def _get(self, key):
+        if key in self._expires and self._expires[key] <= time.time():
+            self.delete(key)
+        return self._data.get(key)
+
+    def get(self, key):
+        return self._get(key)
+
+    def set(self, key, value):
+        self._data[key] = str(value)
+        self._expires.pop(key, None)
+
+    def setex(self, key, ttl, value):
+        self.set(key, value)
+        self.expire(key, ttl)
+
+    def expire(self, key, ttl):
+        if key in self._data:
+            self._expires[key] = time.time() + ttl
+
+    def ttl(self, key):
+        if self._get(key) is None or key not in self._expires:
+            return None
+        return int(round(self._expires[key] - time.time()))
+
+    def delete(self, *keys):
+        for key in keys:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def sadd(self, key, *values):
+        self._data.setdefault(key, set()).update(values)
+
+    def smembers(self, key):
+        return set(self._get(key) or ())
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+class Pipeline(object):
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self._calls.append((getattr(self._redis, name), args))
+            return self
+        return call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [fn(*args) for fn, args in calls]
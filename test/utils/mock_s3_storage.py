@@ -9,11 +9,14 @@ import utils
 class S3Storage(storage.s3.S3Storage):
     __metaclass__ = utils.monkeypatch_class
 
-    def stream_read(self, path):
+    def stream_read(self, path, bytes_range=None):
         path = self._init_path(path)
         key = self._boto_bucket.lookup(path)
         if not key:
             raise IOError('No such key: \'{0}\''.format(path))
+        if bytes_range:
+            key._last_position = bytes_range[0]
+            key._last_byte = bytes_range[1] + 1
         while True:
             buf = key.read(self.buffer_size)
             if not buf:
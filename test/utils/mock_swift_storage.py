@@ -9,13 +9,18 @@ class Connection(swiftclient.client.Connection):
 
     __metaclass__ = utils.monkeypatch_class
 
+    _swift_containers = {}
+    _swift_manifests = {}
+
     def __init__(self, authurl=None, user=None, key=None, retries=5,
                  preauthurl=None, preauthtoken=None, snet=False,
                  starting_backoff=1, max_backoff=64, tenant_name=None,
                  os_options=None, auth_version="1", cacert=None,
                  insecure=False, ssl_compression=True):
-        # initialize a list of containers
-        self._swift_containers = {}
+        # The containers are shared by all the connections
+        self._swift_containers = Connection._swift_containers
+        # Dynamic Large Objects: object -> segments prefix
+        self._swift_manifests = Connection._swift_manifests
 
     ''' Create a container '''
     def put_container(self, container, headers=None, response_dict=None):
@@ -30,26 +35,68 @@ class Connection(swiftclient.client.Connection):
                       delimiter=None, end_marker=None, path=None,
                       full_listing=False):
         lst = []
-        for key, value in self._swift_containers[container].iteritems():
-            if key.startswith(path):
-                lst.append({'name': key})
-        return None, lst
+        prefix = path or prefix or ''
+        for key in sorted(self._swift_containers[container]):
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                inode = {'subdir': prefix + rest[:rest.index(delimiter) + 1]}
+            else:
+                inode = {'name': key}
+            name = inode.get('subdir') or inode['name']
+            if (marker is None or name > marker) and inode not in lst:
+                lst.append(inode)
+        return None, lst[:limit]
 
     ''' attempt to retrieve an object within a container '''
     def get_object(self, container, obj, resp_chunk_size=None,
                    query_string=None, response_dict=None, headers=None):
+        content = self._get_content(container, obj)
+        if headers and 'Range' in headers:
+            start, end = headers['Range'].replace('bytes=', '').split('-')
+            content = content[int(start):int(end) + 1]
+        if resp_chunk_size:
+            content = [content[i:i + resp_chunk_size]
+                       for i in range(0, len(content), resp_chunk_size)]
+        return None, content
+
+    def _get_content(self, container, obj):
         try:
-            return None, self._swift_containers[container][obj]
+            content = self._swift_containers[container][obj]
         except KeyError:
             raise IOError("Could not get content")
+        prefix = self._swift_manifests.get((container, obj))
+        if prefix is not None:
+            objects = self._swift_containers[container]
+            content = ''.join(objects[key] for key in sorted(objects)
+                              if key.startswith(prefix))
+        return content
+
+    def head_object(self, container, obj):
+        content = self._get_content(container, obj)
+        headers = {'content-length': str(len(content))}
+        if (container, obj) in self._swift_manifests:
+            headers['x-object-manifest'] = '{0}/{1}'.format(
+                container, self._swift_manifests[(container, obj)])
+        return headers
 
     ''' Attempt to put the contents into an object within a container '''
     def put_object(self, container, obj, contents, content_length=None,
                    etag=None, chunk_size=None, content_type=None,
                    headers=None, query_string=None, response_dict=None):
+        headers = headers or {}
+        self._swift_manifests.pop((container, obj), None)
         try:
-            if chunk_size is not None:
-                self._swift_containers[container][obj] = contents.read()
+            if 'X-Copy-From' in headers:
+                src_container, src = headers['X-Copy-From'][1:].split('/', 1)
+                contents = self._get_content(src_container, src)
+            elif 'X-Object-Manifest' in headers:
+                self._swift_manifests[(container, obj)] = \
+                    headers['X-Object-Manifest'].split('/', 1)[1]
+            if hasattr(contents, 'read'):
+                self._swift_containers[container][obj] = ''.join(
+                    iter(lambda: contents.read(chunk_size), ''))
             else:
                 self._swift_containers[container][obj] = contents
         except Exception:
@@ -57,4 +104,5 @@ class Connection(swiftclient.client.Connection):
 
     def delete_object(self, container, obj, query_string=None,
                       response_dict=None):
+        self._swift_manifests.pop((container, obj), None)
         self._swift_containers[container].pop(obj, None)